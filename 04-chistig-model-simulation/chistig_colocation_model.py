@@ -19,6 +19,10 @@ def natural_sort(l):
     alphanum_key = lambda key: [convert(c) for c in re.split('([0-9]+)', key)]
     return sorted(l, key=alphanum_key)
 
+# demographic bucket of each race/ethnicity in the 21to29 age group
+DEMOCODES_21TO29 = {'whiteNH': 2, 'blackNH': 4, 'hispanic': 6, 'otherNH': 8}
+
+
 def clean_venue_list(vlist):
 	vlist_remove_duplicates = list(set(vlist))
 	vlist_new = natural_sort(vlist_remove_duplicates)	
@@ -171,28 +175,32 @@ class Model:
         print(MPI.Comm.Get_size(self.comm))
 
         sego_datafile = params['synthpop.ego.file']
-        segodf = pd.read_csv(sego_datafile)
-        segodf['appslist_rel'].fillna(segodf['egoid'], inplace=True)
-        segodf['appslist_norel'].fillna(segodf['egoid'], inplace=True)
+        segodf = pd.read_csv(sego_datafile, usecols=['numeric_id', 'egoid', 'age', 'agegroup', 'race_ethnicity', 'demographic_bucket', 'hiv_status', 'any_serious',
+                                                     'assigned_empego_for_venues', 'assigned_empego_rel', 'assigned_empego_norel', 'appslist_rel', 'appslist_norel'],
+                             dtype={'egoid': str, 'agegroup': str, 'race_ethnicity': str, 'assigned_empego_for_venues': str, 'assigned_empego_rel': str, 
+                                    'assigned_empego_norel': str, 'appslist_rel': str, 'appslist_norel': str})
+        segodf['appslist_rel'] = segodf['appslist_rel'].fillna(segodf['egoid'])
+        segodf['appslist_norel'] = segodf['appslist_norel'].fillna(segodf['egoid'])
+        segodf['any_serious'] = segodf['any_serious'].astype(int)
 
         self.egoidcounter = 1
-        for index, row in segodf.iterrows():
-            sego = Ego(row['numeric_id'], self.rank)
-            sego.egoid = row['egoid']
-            sego.age = row['age']
+        for row in segodf.itertuples(index=False):
+            sego = Ego(row.numeric_id, self.rank)
+            sego.egoid = row.egoid
+            sego.age = row.age
             # print(sego.age)
-            sego.agegroup = row['agegroup']
-            sego.raceethnicity = row['race_ethnicity']
-            sego.democode = row['demographic_bucket']
-            sego.hivstatus = row['hiv_status']
-            sego.eego_venues = row['assigned_empego_for_venues']
-            sego.relationshipstatus = int(row['any_serious'])
-            sego.eego_relationship = row['assigned_empego_rel']
-            sego.eego_norelationship = row['assigned_empego_norel']
-            sego.apps_rel = row['appslist_rel']
-            sego.apps_norel = row['appslist_norel']        
-            sego.venues_attended = row['egoid']
-            sego.apps_used = row['egoid']
+            sego.agegroup = row.agegroup
+            sego.raceethnicity = row.race_ethnicity
+            sego.democode = row.demographic_bucket
+            sego.hivstatus = row.hiv_status
+            sego.eego_venues = row.assigned_empego_for_venues
+            sego.relationshipstatus = row.any_serious
+            sego.eego_relationship = row.assigned_empego_rel
+            sego.eego_norelationship = row.assigned_empego_norel
+            sego.apps_rel = row.appslist_rel
+            sego.apps_norel = row.appslist_norel        
+            sego.venues_attended = row.egoid
+            sego.apps_used = row.egoid
             self.context.add(sego)
             self.egoidcounter += 1
 
@@ -224,6 +232,7 @@ class Model:
         self.context.synchronize(restore_agent)
 
         egos_over_thirty = []
+        egos_turning_21 = []
         for sego in self.context.agents(Ego.TYPE):
             # sego.step()
             ################
@@ -257,38 +266,11 @@ class Model:
             # if so, reassign demographic group and new ego assignments
             #############################################################
             if (sego.age >= 21) and (sego.agegroup == '16to20'):
-                # update ego agegroup
-                sego.agegroup = '21to29'
-
-                # update ego demogroup
-                if sego.raceethnicity == 'whiteNH':
-                    sego.democode = 2
-                elif sego.raceethnicity == 'blackNH':
-                    sego.democode = 4
-                elif sego.raceethnicity == 'hispanic':
-                    sego.democode = 6
-                else:
-                    assert (sego.raceethnicity == 'otherNH')
-                    sego.democode = 8
-    
-                # update empirical ego for venues
-                sego.eego_venues = random.choice(self.empop_demo_buckets[sego.democode])
-
-                # update empirical ego for rel
-                sego.eego_relationship = random.choice(self.empop_demo_rel_buckets[sego.democode]['rel'])
-                if sego.eego_relationship in self.empop_appuse_dict.keys():
-                    sego.apps_rel = self.empop_appuse_dict[sego.eego_relationship]
-                else:
-                    sego.apps_rel = sego.egoid
-
-                # update empirical ego for no rel  
-                sego.eego_norelationship = random.choice(self.empop_demo_rel_buckets[sego.democode]['no_rel'])
-                if sego.eego_norelationship in self.empop_appuse_dict.keys():
-                    sego.apps_norel = self.empop_appuse_dict[sego.eego_norelationship]
-                else:
-                    sego.apps_norel = sego.egoid
+                egos_turning_21.append(sego)
 
+        self.update_agegroups(egos_turning_21)
 
+        for sego in self.context.agents(Ego.TYPE):
             ################
             # attend venues 
             ################
@@ -325,6 +307,29 @@ class Model:
             print("")
 
 
+    def update_agegroups(self, segos):
+        """Moves a batch of egos that have turned 21 into the 21to29 age group and 
+        redraws their empirical egos for venues, relationship and no relationship 
+        appuse, with one draw per demographic bucket for all of the bucket's egos."""
+        segos_by_democode = {}
+        for sego in segos:
+            # update ego agegroup and demogroup
+            sego.agegroup = '21to29'
+            sego.democode = DEMOCODES_21TO29[sego.raceethnicity]
+            segos_by_democode.setdefault(sego.democode, []).append(sego)
+
+        for democode, _segos in segos_by_democode.items():
+            # update empirical egos for venues, rel and no rel
+            _eegos_venues = random.choices(self.empop_demo_buckets[democode], k=len(_segos))
+            _eegos_relationship = random.choices(self.empop_demo_rel_buckets[democode]['rel'], k=len(_segos))
+            _eegos_norelationship = random.choices(self.empop_demo_rel_buckets[democode]['no_rel'], k=len(_segos))
+            for sego, eego_venues, eego_relationship, eego_norelationship in zip(_segos, _eegos_venues, _eegos_relationship, _eegos_norelationship):
+                sego.eego_venues = eego_venues
+                sego.eego_relationship = eego_relationship
+                sego.apps_rel = self.empop_appuse_dict.get(eego_relationship, sego.egoid)
+                sego.eego_norelationship = eego_norelationship
+                sego.apps_norel = self.empop_appuse_dict.get(eego_norelationship, sego.egoid)
+
     def log_agents(self):
         tick = self.runner.schedule.tick 
         for sego in self.context.agents():
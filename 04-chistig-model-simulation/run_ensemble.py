@@ -0,0 +1,276 @@
+"""Runs an experiment's treatment/seed matrix on a local pool of workers.
+
+The matrix is the `input_args_*.txt` file written by `setup_hpc_runs_nov23.py`
+or `02-network-edge-calibration/step3a_edge_calibration.py`: one run per line,
+whose whitespace separated fields are handed to the simulation Rscript exactly
+as the sbatch array task would. Instead of one scheduler task per line, a fixed
+pool of workers, sized to the allocation, pulls the next pending run from a
+shared queue as soon as it is idle, so long and short runs balance out.
+
+Every finished attempt is appended to a JSON lines ledger. Rerunning the same
+command skips the runs the ledger already records as done, so a sweep that was
+interrupted (or ran out of wall time) resumes where it stopped. Failed runs are
+retried up to `--retries` times before they are recorded as failed.
+
+Works the same inside a SLURM allocation and on a single Linux box:
+
+    python run_ensemble.py input_args_nov23.txt simtest_23nov2024.R
+    python run_ensemble.py input_args_nov23.txt simtest_23nov2024.R --workers 8 --retries 2
+"""
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import argparse
+import threading
+import subprocess
+
+
+def allocated_workers():
+	"""Returns the number of runs to keep going at once.
+
+	Uses the cpus SLURM allocated to the job when running inside an allocation
+	and otherwise the cpus this process may run on.
+
+	Returns:
+		int: the number of workers.
+	"""
+	for _var in ('SLURM_CPUS_PER_TASK', 'SLURM_CPUS_ON_NODE'):
+		if os.environ.get(_var, '').isdigit():
+			return max(1, int(os.environ[_var]))
+	if hasattr(os, 'sched_getaffinity'):
+		return max(1, len(os.sched_getaffinity(0)))
+	return max(1, os.cpu_count() or 1)
+
+
+def read_input_args(fname):
+	"""Reads the treatment/seed matrix of an input args file.
+
+	Args:
+		fname: path to the `input_args_*.txt` file, one run per line.
+
+	Returns:
+		list: a (run, arguments) tuple per non empty line, where run is the
+		line's first field (the sbatch array task id) and arguments are all the
+		fields, as passed on the Rscript command line.
+	"""
+	runs = []
+	with open(fname) as _file:
+		for _line in _file:
+			_args = _line.split()
+			if _args:
+				runs.append((_args[0], _args))
+	return runs
+
+
+def read_ledger(fname):
+	"""Reads the completion ledger of earlier invocations.
+
+	Args:
+		fname: path to the JSON lines ledger; it need not exist yet.
+
+	Returns:
+		tuple: the set of runs recorded as done, a dictionary with the longest
+		recorded duration of each run, in seconds, and one with the number of
+		attempts recorded for each run.
+	"""
+	done = set()
+	seconds = {}
+	attempts = {}
+	if not os.path.exists(fname):
+		return done, seconds, attempts
+	with open(fname) as _file:
+		for _line in _file:
+			try:
+				_entry = json.loads(_line)
+			except ValueError:
+				# a line cut short when an earlier invocation was killed
+				continue
+			if _entry.get('status') == 'done':
+				done.add(_entry['run'])
+			seconds[_entry['run']] = max(seconds.get(_entry['run'], 0.0), _entry.get('seconds', 0.0))
+			attempts[_entry['run']] = max(attempts.get(_entry['run'], 0), _entry.get('attempt', 0))
+	return done, seconds, attempts
+
+
+class EnsembleRunner:
+	"""Keeps a fixed number of runs going until the matrix is exhausted.
+
+	Each worker is a long lived thread that takes the next run off a shared
+	queue, runs it as a child process and records the attempt in the ledger.
+	Failed runs go back on the queue until they have used up their retries.
+	"""
+
+	def __init__(self, command, ledger_file, log_dir, workers, retries):
+		"""Initializes the runner.
+
+		Args:
+			command: the command line prefix each run's arguments are appended to.
+			ledger_file: path to the JSON lines completion ledger.
+			log_dir: directory that receives each attempt's standard out and error.
+			workers: number of runs to keep going at once.
+			retries: number of times a failed run is attempted again.
+		"""
+		self.command = command
+		self.ledger_file = ledger_file
+		self.log_dir = log_dir
+		self.workers = workers
+		self.retries = retries
+		self.queue = queue.Queue()
+		self.lock = threading.Lock()
+		self.processes = set()
+		self.stopping = False
+		self.failed = []
+		self.first_attempt = {}
+
+	def record(self, entry):
+		"""Appends one attempt to the ledger.
+
+		Args:
+			entry: dictionary describing the attempt.
+		"""
+		with self.lock:
+			with open(self.ledger_file, 'a') as _file:
+				_file.write(json.dumps(entry) + '\n')
+				_file.flush()
+				os.fsync(_file.fileno())
+
+	def attempt(self, run, args, attempt):
+		"""Runs one attempt of a run in a child process.
+
+		Args:
+			run: the run's identifier, the first field of its input args line.
+			args: the run's arguments.
+			attempt: the number of this attempt, starting at 1.
+
+		Returns:
+			dict: the ledger entry describing the attempt.
+		"""
+		_log = os.path.join(self.log_dir, f'run_{run}.{attempt}.out')
+		_start = time.time()
+		with open(_log, 'w') as _out:
+			_out.write(' '.join(args) + '\n')
+			_out.flush()
+			try:
+				_process = subprocess.Popen(self.command + args, stdout=_out, stderr=subprocess.STDOUT,
+											stdin=subprocess.DEVNULL, start_new_session=True)
+			except OSError as _error:
+				_out.write(f'{_error}\n')
+				_returncode = None
+			else:
+				with self.lock:
+					self.processes.add(_process)
+				_returncode = _process.wait()
+				with self.lock:
+					self.processes.discard(_process)
+		return {'run': run, 'args': args, 'attempt': attempt,
+				'status': 'done' if _returncode == 0 else 'failed', 'returncode': _returncode,
+				'seconds': round(time.time() - _start, 3), 'host': os.uname().nodename, 'log': _log}
+
+	def work(self):
+		"""Worker loop: takes runs off the queue until it is drained."""
+		while not self.stopping:
+			try:
+				_run, _args, _attempt = self.queue.get_nowait()
+			except queue.Empty:
+				return
+			_entry = self.attempt(_run, _args, _attempt)
+			if self.stopping:
+				# an interrupted run is left out of the ledger so that it is rerun
+				return
+			self.record(_entry)
+			print(f"run {_run} attempt {_attempt}: {_entry['status']} "
+				  f"(returncode {_entry['returncode']}, {_entry['seconds']:.0f}s)", flush=True)
+			if _entry['status'] != 'done':
+				if _attempt < self.first_attempt[_run] + self.retries:
+					self.queue.put((_run, _args, _attempt + 1))
+				else:
+					with self.lock:
+						self.failed.append(_run)
+
+	def stop(self, signum=None, frame=None):
+		"""Stops handing out runs and terminates the ones in progress."""
+		self.stopping = True
+		with self.lock:
+			for _process in self.processes:
+				try:
+					os.killpg(_process.pid, signal.SIGTERM)
+				except OSError:
+					pass
+
+	def run(self, runs, attempts=None):
+		"""Runs the given runs to completion.
+
+		Args:
+			runs: list of (run, arguments) tuples, in the order to start them.
+			attempts: optional dictionary with the number of attempts earlier
+				invocations made of each run, so that attempts keep counting up.
+
+		Returns:
+			list: the runs that still failed after all of their retries.
+		"""
+		attempts = attempts or {}
+		for _run, _args in runs:
+			self.queue.put((_run, _args, attempts.get(_run, 0) + 1))
+		self.first_attempt = {_run: attempts.get(_run, 0) + 1 for _run, _ in runs}
+		_threads = [threading.Thread(target=self.work, daemon=True) for _ in range(min(self.workers, len(runs)))]
+		for _thread in _threads:
+			_thread.start()
+		for _thread in _threads:
+			# join with a timeout so that the main thread still sees signals
+			while _thread.is_alive():
+				_thread.join(1.0)
+		return self.failed
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Runs a treatment/seed matrix on a local worker pool.')
+	parser.add_argument('input_args', help='input args file, one run per line')
+	parser.add_argument('rscript', help='simulation Rscript each run passes its arguments to')
+	parser.add_argument('--workers', type=int, default=0,
+						help='number of runs to keep going at once (default: the allocated cpus)')
+	parser.add_argument('--retries', type=int, default=1, help='number of times a failed run is attempted again')
+	parser.add_argument('--ledger', default='', help='completion ledger (default: <input args>.ledger.jsonl)')
+	parser.add_argument('--log-dir', default='', help='per run output directory (default: <input args>.logs)')
+	parser.add_argument('--runs', default='', help='comma separated subset of runs to do (default: all)')
+	parser.add_argument('--command', default='Rscript', help='interpreter the Rscript is run with')
+	args = parser.parse_args(argv)
+
+	_stem = os.path.splitext(args.input_args)[0]
+	ledger_file = args.ledger or f'{_stem}.ledger.jsonl'
+	log_dir = args.log_dir or f'{_stem}.logs'
+	os.makedirs(log_dir, exist_ok=True)
+
+	runs = read_input_args(args.input_args)
+	if args.runs:
+		_subset = set(args.runs.split(','))
+		runs = [_r for _r in runs if _r[0] in _subset]
+	done, seconds, attempts = read_ledger(ledger_file)
+	pending = [_r for _r in runs if _r[0] not in done]
+	# start the runs known to take longest first, so that the short ones fill in at the end
+	pending.sort(key=lambda _r: -seconds.get(_r[0], float('inf')))
+
+	workers = args.workers if args.workers > 0 else allocated_workers()
+	print(f'{len(runs)} runs, {len(runs) - len(pending)} already done, {len(pending)} to do on {workers} workers',
+		  flush=True)
+	runner = EnsembleRunner(args.command.split() + [args.rscript], ledger_file, log_dir, workers, args.retries)
+	signal.signal(signal.SIGTERM, runner.stop)
+	try:
+		failed = runner.run(pending, attempts)
+	except KeyboardInterrupt:
+		runner.stop()
+		print('interrupted; rerun the same command to resume', file=sys.stderr)
+		return 130
+	if runner.stopping:
+		print('stopped; rerun the same command to resume', file=sys.stderr)
+		return 143
+	if failed:
+		print(f"{len(failed)} runs failed after {args.retries} retries: {','.join(failed)}", file=sys.stderr)
+		return 1
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -3,13 +3,24 @@ import re
 import math
 import pandas as pd
 import numpy as np
+from scipy import sparse
 from typing import Dict, Tuple
 from mpi4py import MPI
 from dataclasses import dataclass
 import yaml
 import time
-
-from repast4py import core, schedule, logging, parameters, random 
+import json
+import struct
+import zlib
+import queue
+import threading
+import csv
+import os
+import shutil
+import hashlib
+import atexit
+
+from repast4py import core, schedule, logging, parameters, random, util
 from repast4py import context as ctx
 
 
@@ -24,26 +35,1565 @@ def clean_venue_list(vlist):
 	vlist_new = natural_sort(vlist_remove_duplicates)	
 	return vlist_new
 
+
+def weekly_attendance_prob(daily_probs):
+    """Converts daily venue attendance probabilities into the probability
+    of attending at least once over a 7 day week, i.e. 1 - (1 - p)^7.
+    Daily probabilities above 1 are treated as certain attendance.
+    """
+    daily_probs = np.clip(np.asarray(daily_probs, dtype=np.float64), 0.0, 1.0)
+    return 1.0 - (1.0 - daily_probs) ** 7
+
+
+def build_attendance_matrix(venue_attendance_dict, venues=(), eegos=()):
+    """Compiles the nested empirical ego -> venue -> attendance frequency dict
+    into a sparse CSR matrix with one row per empirical ego and one column per venue.
+    The row and column indices double as the integer codes of the empirical egos
+    and venues, so the natural order of their ids is also the order of their codes.
+
+    Args:
+        venue_attendance_dict: the empop.venue.attendance parameter
+        venues: any venues to include as columns in addition to those attended by
+                the empirical egos (e.g., all the venues in venue.types)
+        eegos: any empirical egos to include as (empty) rows in addition to those
+               in venue_attendance_dict
+
+    Returns:
+        A tuple of the float32 CSR matrix of daily attendance frequencies, the
+        empirical ego labels of its rows and the venue labels of its columns,
+        both in natural order.
+    """
+    eego_labels = clean_venue_list(list(eegos) + list(venue_attendance_dict.keys()))
+    venue_labels = clean_venue_list(list(venues) + [thisvenue for thisvenuesdict in venue_attendance_dict.values() for thisvenue in thisvenuesdict])
+    venue_index = {thisvenue: col for col, thisvenue in enumerate(venue_labels)}
+    indptr = [0]
+    indices = []
+    data = []
+    for thiseego in eego_labels:
+        _eego_venues = sorted(venue_attendance_dict.get(thiseego, {}).items(), key=lambda item: venue_index[item[0]])
+        indices.extend(venue_index[thisvenue] for thisvenue, _ in _eego_venues)
+        data.extend(thisattendancefreq for _, thisattendancefreq in _eego_venues)
+        indptr.append(len(indices))
+    matrix = sparse.csr_matrix((np.array(data, dtype=np.float32), np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int32)),
+                               shape=(len(eego_labels), len(venue_labels)))
+    return matrix, eego_labels, venue_labels
+
+
+def segment_positions(starts, counts):
+    """Returns the positions covered by the segments [starts[i], starts[i] + counts[i])
+    of a flat array, concatenated in order."""
+    counts = np.asarray(counts, dtype=np.int64)
+    return np.arange(counts.sum()) + np.repeat(np.asarray(starts, dtype=np.int64) - (np.cumsum(counts) - counts), counts)
+
+
+def gather_rows(indptr, codes, rows):
+    """Gathers the given rows of a CSR layout (e.g., the app codes of a batch of empirical egos).
+
+    Returns:
+        A tuple of the row offsets (one more than the number of rows) and the gathered codes.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    offsets = np.zeros(rows.size + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets, codes[segment_positions(starts, counts)]
+
+
+def plan_rebalance(counts) -> list:
+    """Plans the moves of egos that even out the given numbers of egos of the ranks, from the
+    ranks above their share to those below it.
+
+    Returns:
+        A list of (source rank, destination rank, number of egos) moves.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    targets = np.full(len(counts), counts.sum() // len(counts))
+    # the remainder is left with the most loaded ranks
+    targets[np.argsort(-counts, kind='stable')[:counts.sum() % len(counts)]] += 1
+    surplus = counts - targets
+    sources = [[rank, n] for rank, n in enumerate(surplus.tolist()) if n > 0]
+    destinations = [[rank, -n] for rank, n in enumerate(surplus.tolist()) if n < 0]
+    moves = []
+    while sources and destinations:
+        n = min(sources[0][1], destinations[0][1])
+        moves.append((sources[0][0], destinations[0][0], n))
+        sources[0][1] -= n
+        destinations[0][1] -= n
+        if sources[0][1] == 0:
+            sources.pop(0)
+        if destinations[0][1] == 0:
+            destinations.pop(0)
+    return moves
+
+
+def allgather_code_sets(comm, numeric_ids, owned_ids, owned_egoids, offsets, codes):
+    """Exchanges the code sets (in CSR layout) of the egos that each rank owns between the
+    ranks as compact arrays, and returns the code sets of all the given egos on every rank.
+
+    Args:
+        comm: the communicator over which the egos are distributed
+        numeric_ids: the numeric ids of the egos to return, the same on every rank
+        owned_ids: the numeric ids of the egos this rank owns among them
+        owned_egoids: their egoids, or None when the egoids are not needed
+        offsets, codes: their code sets
+
+    Returns:
+        A tuple of the egoids of numeric_ids (or None) and the (offsets, codes) of their code sets.
+    """
+    parts = comm.allgather((owned_ids, owned_egoids, np.diff(offsets), codes))
+    indptr = np.zeros(sum(len(part[0]) for part in parts) + 1, dtype=np.int64)
+    np.cumsum(np.concatenate([part[2] for part in parts]), out=indptr[1:])
+    positions = pd.Index(np.concatenate([part[0] for part in parts])).get_indexer(numeric_ids)
+    assert((positions >= 0).all())
+    egoids = np.concatenate([part[1] for part in parts])[positions] if owned_egoids is not None else None
+    return egoids, gather_rows(indptr, np.concatenate([part[3] for part in parts]), positions)
+
+
+def encode_labels(values, labels):
+    """Encodes a column of labels (e.g., race/ethnicity) as their index in labels."""
+    codes = pd.Categorical(values, categories=labels).codes
+    assert((codes >= 0).all())
+    return codes
+
+
+def dating_lookup(index, dating, nondating):
+    """Builds a lookup array indexed by venue (or app) code that is True for the
+    dating and False for the nondating venues (or apps). Every code must be in one of the two."""
+    is_dating = np.full(len(index), -1, dtype=np.int8)
+    is_dating[[index[thislabel] for thislabel in nondating]] = 0
+    is_dating[[index[thislabel] for thislabel in dating]] = 1
+    assert((is_dating >= 0).all())
+    return is_dating.astype(np.bool_)
+
+
+def split_code_sets(offsets, codes, mask):
+    """Splits code sets in CSR layout by a per-code boolean mask (e.g. the dating lookup).
+
+    Returns:
+        A tuple of the (offsets, codes) of the masked and of the unmasked code sets,
+        with each set staying in its original order.
+    """
+    n = len(offsets) - 1
+    owners = np.repeat(np.arange(n), np.diff(offsets))
+    selected = mask[codes]
+    masked_offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(owners[selected], minlength=n), out=masked_offsets[1:])
+    return (masked_offsets, codes[selected]), (offsets - masked_offsets, codes[~selected])
+
+
+def join_label_rows(labels, offsets, codes, placeholders):
+    """Materializes code sets in CSR layout as the '|'-joined labels exported to R,
+    using the placeholder (the ego's egoid) of each empty set."""
+    _labels = labels[codes].tolist()
+    return ['|'.join(_labels[start:end]) if start < end else placeholder
+            for start, end, placeholder in zip(offsets[:-1].tolist(), offsets[1:].tolist(), placeholders)]
+
+
+# the purposes the counter-based streams are keyed by, so that each purpose draws from its own stream
+STREAM_PURPOSES = ('attendance', 'eego')
+
+_GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+
+
+def mix64(x):
+    """The splitmix64 finalizer, applied elementwise to uint64 values."""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def hash_words(key, *words):
+    """Chains the given words (non-negative integers or arrays of them, broadcast against
+    each other) into the uint64 key with one splitmix64 round each."""
+    h = np.asarray(key, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for word in words:
+            h = mix64((h ^ np.asarray(word, dtype=np.int64).astype(np.uint64)) + _GOLDEN_GAMMA)
+    return h
+
+
+class CounterStream:
+    """A counter-based random stream: each uniform is a hash of (seed, purpose, tick,
+    numeric id, counter) rather than the next output of a generator, so an ego's draws
+    do not depend on which other egos were drawn for before it, in what order or on
+    which rank.
+
+    Args:
+        seed: the seed of the run (or of the replicate)
+        purpose: what is drawn, one of STREAM_PURPOSES
+        tick: the tick the draws are made at
+    """
+
+    def __init__(self, seed: int, purpose: str, tick: float):
+        self.key = hash_words(0, seed, STREAM_PURPOSES.index(purpose), int(tick))
+
+    def uniforms(self, numeric_ids, counters=0) -> np.ndarray:
+        """Returns the uniform in [0, 1) of each of the given numeric ids (and counters,
+        e.g. the venue codes when an ego draws once per venue)."""
+        h = hash_words(self.key, numeric_ids, counters)
+        return (h >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+
+def draw_bucket_members(indptr, members, buckets, rng, numeric_ids=None):
+    """Draws one member uniformly at random from each of the given buckets (e.g. an
+    empirical ego from each ego's demographic bucket), where the members of bucket b
+    are members[indptr[b]:indptr[b + 1]]. A CounterStream draws by the numeric_ids
+    of the egos the buckets belong to. Every bucket drawn from must have members."""
+    buckets = np.asarray(buckets, dtype=np.int64)
+    starts = indptr[buckets]
+    counts = indptr[buckets + 1] - starts
+    # an empty bucket would otherwise draw the last member of the bucket before it
+    assert((counts > 0).all()), f'no members to draw from in the buckets {np.unique(buckets[counts <= 0]).tolist()}'
+    if isinstance(rng, CounterStream):
+        picks = np.minimum((rng.uniforms(numeric_ids) * counts).astype(np.int64), counts - 1)
+    else:
+        picks = rng.integers(0, counts)
+    return members[starts + picks]
+
+
+def draw_weekly_attendance(eego_rows, indptr, indices, weekly_probs, rng, numeric_ids=None):
+    """Draws a week of venue attendance for a batch of egos from the rows of the
+    compiled attendance matrix, with one draw per (ego, venue) pair.
+
+    Args:
+        eego_rows: the attendance matrix row of each ego's empirical ego
+        indptr, indices: the CSR row pointers and venue columns of the attendance matrix
+        weekly_probs: the weekly attendance probability of each stored matrix entry
+        rng: the numpy Generator to draw from, or a CounterStream keyed by the 
+             egos' numeric_ids and the venue columns
+        numeric_ids: the numeric id of each ego, for a CounterStream
+
+    Returns:
+        A tuple of the row offsets (one more than the number of egos) and the
+        venue columns attended, i.e. the attended venues in CSR layout with
+        each ego's venues in natural order.
+    """
+    eego_rows = np.asarray(eego_rows, dtype=np.int64)
+    starts = indptr[eego_rows]
+    counts = indptr[eego_rows + 1] - starts
+    # position of each (ego, venue) pair in the matrix's stored entries, and the ego it belongs to
+    owners = np.repeat(np.arange(eego_rows.size), counts)
+    entries = segment_positions(starts, counts)
+    if isinstance(rng, CounterStream):
+        uniforms = rng.uniforms(np.asarray(numeric_ids, dtype=np.int64)[owners], indices[entries])
+    else:
+        uniforms = rng.random(entries.size)
+    attended = uniforms < weekly_probs[entries]
+    offsets = np.zeros(eego_rows.size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(owners[attended], minlength=eego_rows.size), out=offsets[1:])
+    return offsets, indices[entries[attended]]
+
+def encode_label_lists(label_lists, key_labels, label_index):
+    """Encodes '|'-joined label lists keyed by entity (e.g., empop.app.use) into
+    CSR layout, with one row per entry of key_labels and each row holding the
+    sorted integer codes of its labels. Keys without a list get an empty row.
+
+    Returns:
+        A tuple of the int32 row pointers and the int32 codes.
+    """
+    indptr = np.zeros(len(key_labels) + 1, dtype=np.int32)
+    codes = []
+    for row, thiskey in enumerate(key_labels):
+        if thiskey in label_lists:
+            codes.extend(sorted(set(label_index[thislabel] for thislabel in label_lists[thiskey].split('|'))))
+        indptr[row + 1] = len(codes)
+    return indptr, np.array(codes, dtype=np.int32)
+
+
+def join_labels(labels, codes, placeholder):
+    """Materializes a set of integer codes as the '|'-joined labels that are exported
+    to R, or as the placeholder (the ego's egoid) when the set is empty."""
+    if len(codes) == 0:
+        return placeholder
+    return '|'.join(labels[codes])
+
+
+def colocated_pairs(offsets, codes, n_codes, cap=0):
+    """Finds the pairs of egos that share at least one venue, by projecting the 
+    ego x venue attendance onto the egos through the venue -> attendees inverted index,
+    so the work is proportional to the actual co-attendance.
+
+    Args:
+        offsets, codes: the CSR layout of the egos' venue codes
+        n_codes: the number of venue codes
+        cap: venues with more attendees than cap are left out of the projection 
+            (0 for no cap), as every pair of their attendees would be colocated
+
+    Returns:
+        A tuple of the positions (in the CSR rows) of the first and second ego of 
+        each pair, with first < second and ordered by first then second, the number 
+        of venues the pair shares, and the codes of the venues that were capped.
+    """
+    attendance = sparse.csr_matrix((np.ones(len(codes), dtype=np.int32), codes, offsets),
+                                   shape=(len(offsets) - 1, n_codes))
+    attendees = np.bincount(codes, minlength=n_codes)
+    capped = np.flatnonzero(attendees > cap) if cap > 0 else np.empty(0, dtype=np.int64)
+    if capped.size > 0:
+        attendance = attendance[:, np.flatnonzero(attendees <= cap)]
+    # the inverted index, the attendees of each venue
+    inverted = attendance.T.tocsr()
+    shared = sparse.triu(attendance @ inverted, k=1, format='csr')
+    shared.sort_indices()
+    shared = shared.tocoo()
+    return shared.row.astype(np.int32), shared.col.astype(np.int32), shared.data.astype(np.int32), capped
+
+# the EpiModel race_ethnicity codes are the index in RACE_ETHNICITIES plus one
+RACE_ETHNICITIES = ('blackNH', 'hispanic', 'otherNH', 'whiteNH')
+AGE_GROUPS = ('16to20', '21to29')
+# demographic bucket of each race/ethnicity (in RACE_ETHNICITIES order) in each age group
+DEMOCODES_16TO20 = np.array([3, 5, 7, 1], dtype=np.int8)
+DEMOCODES_21TO29 = np.array([4, 6, 8, 2], dtype=np.int8)
+
+# the columns of the synthetic population file that are used, and how they are parsed
+SYNTHPOP_DTYPES = {
+    'numeric_id': np.int64,
+    'egoid': str,
+    'age': np.float32,
+    'agegroup': 'category',
+    'race_ethnicity': 'category',
+    'demographic_bucket': np.int8,
+    'hiv_status': np.int8,
+    'any_serious': None, # 0/1 or TRUE/FALSE
+    'assigned_empego': str,
+}
+# bumped when the parsed synthpop columns change, so older snapshots of a population are rebuilt
+SYNTHPOP_SNAPSHOT_VERSION = 1
+
+
+def file_hash(fname: str) -> str:
+    """Returns the sha256 hex digest of the content of a file."""
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_synthpop(fname: str, cache_dir: str = None) -> Dict:
+    """Loads the synthetic population as columns ready for the agent table, reading only the
+    used columns with explicit dtypes.
+
+    The parsed columns are cached as a binary snapshot (.npz) named after the hash of the
+    file's content and SYNTHPOP_SNAPSHOT_VERSION, in cache_dir (by default next to the file), so later runs on the same
+    population load the snapshot instead of parsing the csv. The cache is skipped when the 
+    directory cannot be written to.
+
+    Returns:
+        A dict of the numeric_id, egoid, age, agegroup, raceethnicity, democode, hivstatus,
+        relationshipstatus and assigned_empego columns, with the categories as codes.
+    """
+    cache_dir = os.path.dirname(os.path.abspath(fname)) if not cache_dir else cache_dir
+    snapshot = os.path.join(cache_dir, f'{os.path.basename(fname)}.{file_hash(fname)[:16]}.v{SYNTHPOP_SNAPSHOT_VERSION}.npz')
+    if os.path.exists(snapshot):
+        with np.load(snapshot) as cached:
+            columns = {name: cached[name] for name in cached.files}
+        columns['egoid'] = columns['egoid'].astype(object)
+        columns['assigned_empego'] = columns['assigned_empego'].astype(object)
+        return columns
+
+    segodf = pd.read_csv(fname, usecols=list(SYNTHPOP_DTYPES), dtype={name: dtype for name, dtype in SYNTHPOP_DTYPES.items() if dtype is not None})
+    columns = {'numeric_id': segodf['numeric_id'].to_numpy(),
+               'egoid': segodf['egoid'].to_numpy(dtype=object),
+               'age': segodf['age'].to_numpy(),
+               'agegroup': encode_labels(segodf['agegroup'], AGE_GROUPS).astype(np.int8),
+               'raceethnicity': encode_labels(segodf['race_ethnicity'], RACE_ETHNICITIES).astype(np.int8),
+               'democode': segodf['demographic_bucket'].to_numpy(),
+               'hivstatus': segodf['hiv_status'].to_numpy(),
+               'relationshipstatus': segodf['any_serious'].astype(np.int8).to_numpy(),
+               'assigned_empego': segodf['assigned_empego'].to_numpy(dtype=object)}
+    try:
+        # written to a temporary file first, as concurrent runs may be caching the same population
+        temporary = f'{snapshot}.{os.getpid()}.tmp.npz'
+        np.savez(temporary, **{name: column.astype(str) if column.dtype == object else column for name, column in columns.items()})
+        os.replace(temporary, snapshot)
+    except OSError:
+        pass
+    return columns
+
+
+def publish_shared_arrays(shared_dir: str, key: str, build) -> str:
+    """Publishes the read-only arrays returned by build() under key in shared_dir (e.g. in /dev/shm,
+    so that they are shared by all the runs on a node), unless they are already published.
+
+    The arrays are saved as .npy files into a temporary directory that is then renamed to key,
+    so concurrent runs see either all of the arrays or none of them, and the runs that lose the
+    race to publish them attach to the winner's. Object arrays are saved as strings. Only arrays
+    published by the current user are attached to, as shared_dir may be shared by the users of
+    a node. The published arrays stay in shared_dir until removed with remove_shared_arrays.
+
+    Returns:
+        The directory of the published arrays, to be memory mapped with load_shared_arrays,
+        or '' when they cannot be published there.
+    """
+    published = os.path.join(shared_dir, key)
+    if os.path.isdir(published):
+        return published if os.stat(published).st_uid == os.getuid() else ''
+    arrays = build()
+    temporary = f'{published}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(temporary, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(temporary, name + '.npy'), array.astype(str) if array.dtype == object else array)
+        try:
+            os.rename(temporary, published)
+        except OSError:
+            if not os.path.isdir(published):
+                raise
+            shutil.rmtree(temporary, ignore_errors=True)
+        return published if os.stat(published).st_uid == os.getuid() else ''
+    except OSError:
+        shutil.rmtree(temporary, ignore_errors=True)
+        return ''
+
+
+def remove_shared_arrays(shared_dir: str):
+    """Removes the arrays published in shared_dir by the current user (and the temporary
+    directories of failed publishes), e.g. at the end of a job, as a RAM backed directory
+    such as /dev/shm is not cleared by the end of the runs. Runs that still map the arrays
+    keep them until they exit, and later runs publish them again."""
+    if not os.path.isdir(shared_dir):
+        return
+    for name in os.listdir(shared_dir):
+        path = os.path.join(shared_dir, name)
+        if os.path.isdir(path) and os.stat(path).st_uid == os.getuid():
+            shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.rmdir(shared_dir)
+    except OSError:
+        pass
+
+
+def load_shared_arrays(published: str) -> Dict:
+    # memory maps the arrays published by publish_shared_arrays read-only, their pages are shared by the runs that map them
+    return {os.path.splitext(fname)[0]: np.load(os.path.join(published, fname), mmap_mode='r')
+            for fname in os.listdir(published) if fname.endswith('.npy')}
+
+
+def replicate_name(name: str, replicate: int) -> str:
+    # the agent table column or code set (e.g. 'eego' or 'venues') of a replicate, replicate 0 has the plain name
+    return name if replicate == 0 else f'{name}_{replicate}'
+
+
+class AgentTable:
+    """Columnar (struct-of-arrays) store for the state of the synthetic egos.
+
+    Each ego is one row of the numpy columns below, and the Ego agents are thin views
+    that read and write their row. Rows are found through a dense numeric id -> row index,
+    appended as egos enter and only dropped when the table is compacted, which keeps
+    the rows in the order in which the egos were added.
+
+    The venues attended and apps used by each ego are ragged sets of codes, stored
+    per row as a (start, count) pair into a flat int32 buffer for each set. New sets are
+    appended to the buffer, which is rebuilt from the live rows when it fills up.
+
+    With more than one replicate (see set_replicates), the empirical ego and the code sets
+    carry a replicate axis: replicate 0 is stored in the columns above and each further
+    replicate k in its own eego_k column and venues_k and apps_k code sets (see replicate_name).
+    """
+
+    COLUMNS = {
+        'numeric_id': np.int64,
+        'uid_rank': np.int32,
+        'egoid': object,
+        'age': np.float32,
+        'agegroup': np.int8,
+        'raceethnicity': np.int8,
+        'democode': np.int8,
+        'hivstatus': np.int8,
+        'relationshipstatus': np.int8,
+        'eego': np.int32,
+        'active': np.bool_,
+        'venues_start': np.int64,
+        'venues_count': np.int32,
+        'apps_start': np.int64,
+        'apps_count': np.int32,
+    }
+    CODE_SETS = ('venues', 'apps')
+
+    def __init__(self, capacity: int = 1024):
+        self.set_replicates(1, capacity)
+
+    def set_replicates(self, replicates: int, capacity: int = 1024):
+        """Clears the table and sets the number of replicates of the empirical egos and code sets."""
+        self.replicates = replicates
+        self.columns = dict(AgentTable.COLUMNS)
+        self.code_sets = list(AgentTable.CODE_SETS)
+        for replicate in range(1, replicates):
+            self.columns[replicate_name('eego', replicate)] = np.int32
+            for name in AgentTable.CODE_SETS:
+                self.columns[replicate_name(name, replicate) + '_start'] = np.int64
+                self.columns[replicate_name(name, replicate) + '_count'] = np.int32
+                self.code_sets.append(replicate_name(name, replicate))
+        self.clear(capacity)
+
+    def clear(self, capacity: int = 1024):
+        self.size = 0
+        self.n_active = 0
+        for name, dtype in self.columns.items():
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+        self.id2row = np.full(capacity, -1, dtype=np.int64)
+        for name in self.code_sets:
+            setattr(self, name + '_buffer', np.zeros(4 * capacity, dtype=np.int32))
+            setattr(self, name + '_used', 0)
+
+    def _reserve(self, n: int):
+        if self.size + n <= len(self.active):
+            return
+        if self.size - self.n_active >= n:
+            self.compact()
+            return
+        capacity = max(2 * len(self.active), self.size + n)
+        for name in self.columns:
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+
+    def _reserve_ids(self, max_id: int):
+        if max_id < len(self.id2row):
+            return
+        grown = np.full(max(2 * len(self.id2row), max_id + 1), -1, dtype=np.int64)
+        grown[:len(self.id2row)] = self.id2row
+        self.id2row = grown
+
+    def contains(self, numeric_id: int) -> bool:
+        return numeric_id < len(self.id2row) and self.id2row[numeric_id] >= 0
+
+    def row(self, numeric_id: int) -> int:
+        return self.id2row[numeric_id]
+
+    def view_row(self, numeric_id: int) -> int:
+        """Returns the row of an ego for its Ego view, raising a KeyError when the ego has
+        been removed from the table (e.g. a stale view), as its row may now be another ego's."""
+        if not self.contains(numeric_id):
+            raise KeyError(f'ego {numeric_id} is not in the agent table')
+        return self.id2row[numeric_id]
+
+    def rows(self, numeric_ids) -> np.ndarray:
+        """Returns the rows of the egos with the given numeric ids, or -1 for those not in the table."""
+        numeric_ids = np.asarray(numeric_ids, dtype=np.int64)
+        rows = np.full(numeric_ids.size, -1, dtype=np.int64)
+        known = (numeric_ids >= 0) & (numeric_ids < len(self.id2row))
+        rows[known] = self.id2row[numeric_ids[known]]
+        return rows
+
+    def active_rows(self) -> np.ndarray:
+        return np.flatnonzero(self.active[:self.size])
+
+    def extend(self, numeric_ids, uid_rank: int, **columns) -> np.ndarray:
+        """Appends a row for each of the given numeric ids, filling in any of the
+        given columns and leaving the rest at their defaults.
+
+        Returns:
+            The new rows.
+        """
+        numeric_ids = np.asarray(numeric_ids, dtype=np.int64)
+        n = numeric_ids.size
+        self._reserve(n)
+        self._reserve_ids(int(numeric_ids.max()) if n else 0)
+        rows = np.arange(self.size, self.size + n)
+        self.numeric_id[rows] = numeric_ids
+        self.uid_rank[rows] = uid_rank
+        if 'egoid' not in columns:
+            self.egoid[rows] = ['s' + str(numeric_id).zfill(5) for numeric_id in numeric_ids.tolist()]
+        self.age[rows] = 16.0
+        self.agegroup[rows] = AGE_GROUPS.index('16to20')
+        self.raceethnicity[rows] = RACE_ETHNICITIES.index('blackNH')
+        self.democode[rows] = 1
+        self.hivstatus[rows] = 0
+        self.relationshipstatus[rows] = 0
+        self.eego[rows] = 0 # e001
+        self.active[rows] = True
+        for name in self.code_sets:
+            getattr(self, name + '_start')[rows] = 0
+            getattr(self, name + '_count')[rows] = 0
+        for name, values in columns.items():
+            getattr(self, name)[rows] = values
+        # the further replicates start from the same empirical ego, unless given theirs
+        for replicate in range(1, self.replicates):
+            if replicate_name('eego', replicate) not in columns:
+                getattr(self, replicate_name('eego', replicate))[rows] = self.eego[rows]
+        self.id2row[numeric_ids] = rows
+        self.size += n
+        self.n_active += n
+        return rows
+
+    def add(self, numeric_id: int, uid_rank: int) -> int:
+        return int(self.extend([numeric_id], uid_rank)[0])
+
+    def remove(self, numeric_ids):
+        rows = self.rows(np.atleast_1d(numeric_ids))
+        rows = rows[rows >= 0]
+        self.active[rows] = False
+        self.id2row[self.numeric_id[rows]] = -1
+        self.n_active -= rows.size
+
+    def compact(self):
+        """Drops the rows of the removed egos, keeping the remaining rows in order."""
+        if self.n_active == self.size:
+            return
+        keep = self.active_rows()
+        for name in self.columns:
+            column = getattr(self, name)
+            column[:keep.size] = column[keep]
+        self.size = keep.size
+        self.id2row[self.numeric_id[:self.size]] = np.arange(self.size)
+
+    def gather_codes(self, name: str, rows):
+        """Gathers the code sets (e.g. 'venues') of the given rows in CSR layout.
+
+        Returns:
+            A tuple of the row offsets (one more than the number of rows) and the codes.
+        """
+        starts = getattr(self, name + '_start')[rows]
+        counts = getattr(self, name + '_count')[rows]
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets, getattr(self, name + '_buffer')[segment_positions(starts, counts)]
+
+    def replicate_state(self, row: int) -> Tuple:
+        # the empirical ego and code sets of the further replicates of a row, e.g. for Ego.save
+        return tuple((int(getattr(self, replicate_name('eego', replicate))[row]),) +
+                     tuple(self.codes(replicate_name(name, replicate), row).copy() for name in AgentTable.CODE_SETS)
+                     for replicate in range(1, self.replicates))
+
+    def set_replicate_state(self, row: int, state: Tuple):
+        for replicate, (eego, *code_sets) in enumerate(state, start=1):
+            getattr(self, replicate_name('eego', replicate))[row] = eego
+            for name, codes in zip(AgentTable.CODE_SETS, code_sets):
+                self.set_codes(replicate_name(name, replicate), [row], [0, len(codes)], codes)
+
+    def codes(self, name: str, row: int) -> np.ndarray:
+        """Returns the set of codes (e.g. 'venues') of the given row."""
+        start = getattr(self, name + '_start')[row]
+        return getattr(self, name + '_buffer')[start:start + getattr(self, name + '_count')[row]]
+
+    def set_codes(self, name: str, rows, offsets, codes):
+        """Sets the code sets (e.g. 'venues') of the given rows from CSR layout,
+        where the codes of rows[i] are codes[offsets[i]:offsets[i + 1]]."""
+        codes = np.asarray(codes, dtype=np.int32)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        used = getattr(self, name + '_used')
+        buffer = getattr(self, name + '_buffer')
+        if used + codes.size > buffer.size:
+            # rebuild the buffer from the sets of the rows that are not being replaced
+            live = np.ones(self.size, dtype=np.bool_)
+            live[rows] = False
+            live = np.flatnonzero(live & self.active[:self.size])
+            starts = getattr(self, name + '_start')
+            counts = getattr(self, name + '_count')
+            kept = buffer[segment_positions(starts[live], counts[live])]
+            buffer = np.zeros(max(buffer.size, 2 * (kept.size + codes.size)), dtype=np.int32)
+            buffer[:kept.size] = kept
+            starts[live] = np.cumsum(counts[live]) - counts[live]
+            used = kept.size
+            setattr(self, name + '_buffer', buffer)
+        buffer[used:used + codes.size] = codes
+        getattr(self, name + '_start')[rows] = used + offsets[:-1]
+        getattr(self, name + '_count')[rows] = np.diff(offsets)
+        setattr(self, name + '_used', used + codes.size)
+
+
+agent_table = AgentTable()
+
+
+class _TableColumn:
+    """Exposes a column of the agent table as an attribute of the Ego views,
+    translating codes to labels for the categorical columns."""
+
+    def __init__(self, column: str, pytype=None, labels=None):
+        self.column = column
+        self.pytype = pytype
+        self.labels = labels
+
+    def __get__(self, sego, owner):
+        if sego is None:
+            return self
+        value = getattr(agent_table, self.column)[agent_table.view_row(sego.id)]
+        if self.labels is not None:
+            return self.labels[value]
+        return self.pytype(value)
+
+    def __set__(self, sego, value):
+        if self.labels is not None:
+            value = self.labels.index(value)
+        getattr(agent_table, self.column)[agent_table.view_row(sego.id)] = value
+
+
+class _TableCodes:
+    """Exposes one of the agent table's code sets as an attribute of the Ego views."""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __get__(self, sego, owner):
+        if sego is None:
+            return self
+        return agent_table.codes(self.name, agent_table.view_row(sego.id))
+
+    def __set__(self, sego, codes):
+        agent_table.set_codes(self.name, [agent_table.view_row(sego.id)], [0, len(codes)], codes)
+
+
+class ColumnarLogFile:
+    """Binary file of named numpy columns written in groups of rows (e.g. the ticks
+    logged since the last write), as an alternative to text rows.
+
+    Each column of a group is stored as its raw (optionally zlib compressed) bytes after
+    a JSON group header with the group's info (e.g. its tick range and number of rows),
+    the size and dtype of each of its columns and the labels it appends to the metadata
+    (e.g. the egoids first seen in the group). A JSON footer at the end of the file indexes
+    all the groups, so readers can load only the groups and columns they need, see
+    ColumnarLogReader. A file without its footer (e.g. of a run that was killed) is read
+    by scanning the group headers up to the last complete group. An existing file is never
+    overwritten: like the TabularLogger, the log goes to the next free file name (see fname).
+
+    Layout: MAGIC, the header length as a little endian uint32 and the JSON header with the
+    metadata, then for each group GROUP_MAGIC, its header length as a little endian uint32,
+    its JSON header and the bytes of its columns, and finally the JSON footer, the footer
+    length as a little endian uint64 and MAGIC again.
+    """
+
+    MAGIC = b'CHSTGCOL'
+    GROUP_MAGIC = b'CHSTGGRP'
+
+    def __init__(self, fname: str, metadata: Dict = None, compress: bool = True):
+        self.metadata = {} if metadata is None else metadata
+        self.compress = compress
+        self.groups = []
+        # e.g. agent_log_1.col when agent_log.col was written by an earlier segment of the run
+        self.fname = str(util.find_free_filename(fname))
+        os.makedirs(os.path.dirname(os.path.abspath(self.fname)), exist_ok=True)
+        self.file = open(self.fname, 'wb')
+        header = json.dumps({'metadata': self.metadata, 'compress': self.compress}).encode()
+        self.file.write(ColumnarLogFile.MAGIC)
+        self.file.write(struct.pack('<I', len(header)))
+        self.file.write(header)
+        self.file.flush()
+
+    def write_group(self, columns: Dict, labels: Dict = None, **info):
+        """Appends a group of columns, indexed together with the given info (e.g. tick_min,
+        tick_max and rows), and appends the given labels to those of the metadata."""
+        data = {}
+        sizes = {}
+        for name, column in columns.items():
+            column = np.ascontiguousarray(column)
+            data[name] = column.tobytes()
+            if self.compress:
+                data[name] = zlib.compress(data[name], 1)
+            sizes[name] = [len(data[name]), column.dtype.str, len(column)]
+        labels = {} if labels is None else {name: [str(label) for label in column_labels] for name, column_labels in labels.items()}
+        header = json.dumps(dict(info, columns=sizes, labels=labels)).encode()
+        self.file.write(ColumnarLogFile.GROUP_MAGIC)
+        self.file.write(struct.pack('<I', len(header)))
+        self.file.write(header)
+        offset = self.file.tell()
+        index = {}
+        for name, (nbytes, dtype, length) in sizes.items():
+            index[name] = [offset, nbytes, dtype, length]
+            offset += nbytes
+            self.file.write(data[name])
+        # flushed so that the complete groups are on disk if the run is killed
+        self.file.flush()
+        for name, column_labels in labels.items():
+            self.metadata.setdefault('labels', {}).setdefault(name, []).extend(column_labels)
+        self.groups.append(dict(info, columns=index))
+
+    def close(self):
+        footer = json.dumps({'metadata': self.metadata, 'compress': self.compress, 'groups': self.groups}).encode()
+        self.file.write(footer)
+        self.file.write(struct.pack('<Q', len(footer)))
+        self.file.write(ColumnarLogFile.MAGIC)
+        self.file.close()
+
+
+class ColumnarLogReader:
+    """Reads the groups and columns of a ColumnarLogFile selectively, through its footer index,
+    or through its group headers up to the last complete group if it has no footer."""
+
+    def __init__(self, fname: str):
+        self.fname = fname
+        with open(fname, 'rb') as f:
+            assert(f.read(len(ColumnarLogFile.MAGIC)) == ColumnarLogFile.MAGIC), f'{fname} is not a columnar log'
+            f.seek(max(-8 - len(ColumnarLogFile.MAGIC), -f.seek(0, 2)), 2)
+            (length,) = struct.unpack('<Q', f.read(8).rjust(8, b'\0'))
+            if f.read() == ColumnarLogFile.MAGIC:
+                f.seek(-8 - len(ColumnarLogFile.MAGIC) - length, 2)
+                footer = json.loads(f.read(length))
+            else:
+                footer = self.scan(f)
+        self.metadata = footer['metadata']
+        self.compress = footer['compress']
+        self.groups = footer['groups']
+        self.complete = footer.get('complete', True)
+
+    @staticmethod
+    def scan(f) -> Dict:
+        """Rebuilds the footer of a file that has none from its header and group headers."""
+        size = f.seek(0, 2)
+        f.seek(len(ColumnarLogFile.MAGIC))
+        prefix = f.read(4)
+        assert(len(prefix) == 4), 'the columnar log has no complete header'
+        (length,) = struct.unpack('<I', prefix)
+        header = f.read(length)
+        assert(len(header) == length), 'the columnar log has no complete header'
+        header = json.loads(header)
+        metadata = header['metadata']
+        groups = []
+        while f.read(len(ColumnarLogFile.GROUP_MAGIC)) == ColumnarLogFile.GROUP_MAGIC:
+            prefix = f.read(4)
+            if len(prefix) < 4:
+                break
+            (length,) = struct.unpack('<I', prefix)
+            try:
+                group = json.loads(f.read(length))
+            except ValueError:
+                break
+            offset = f.tell()
+            index = {}
+            for name, (nbytes, dtype, rows) in group['columns'].items():
+                index[name] = [offset, nbytes, dtype, rows]
+                offset += nbytes
+            if offset > size:
+                # the last group was cut short
+                break
+            for name, column_labels in group.pop('labels').items():
+                metadata.setdefault('labels', {}).setdefault(name, []).extend(column_labels)
+            groups.append(dict(group, columns=index))
+            f.seek(offset)
+        return {'metadata': metadata, 'compress': header['compress'], 'groups': groups, 'complete': False}
+
+    def select(self, ticks=None):
+        """Returns the groups that overlap the (first, last) tick range, or all groups."""
+        if ticks is None:
+            return self.groups
+        return [group for group in self.groups if group['tick_max'] >= ticks[0] and group['tick_min'] <= ticks[1]]
+
+    def read_group(self, group: Dict, columns=None) -> Dict:
+        """Reads the given columns (or all columns) of a group."""
+        arrays = {}
+        with open(self.fname, 'rb') as f:
+            for name, (offset, nbytes, dtype, length) in group['columns'].items():
+                if columns is not None and name not in columns:
+                    continue
+                f.seek(offset)
+                data = f.read(nbytes)
+                if self.compress:
+                    data = zlib.decompress(data)
+                arrays[name] = np.frombuffer(data, dtype=dtype, count=length)
+        return arrays
+
+
+class AsyncLogWriter:
+    """Background thread that runs the serialization and disk writes of the logs off the
+    model's step, taking the completed batches (e.g. gathered ticks) through a bounded queue.
+
+    Submitting blocks while the queue is full, so a slow disk slows the model down instead of
+    buffering without bound, and the time spent blocked, the queue depth and the latency of
+    the writes are counted (see stats) to size the queue. An error in a write is raised
+    again by the next submit or by close. The writer is also closed when the interpreter exits,
+    so the batches still in the queue are written even if the driver never ends the model.
+
+    Args:
+        queue_size: the number of batches that can wait to be written
+    """
+
+    def __init__(self, queue_size: int = 8):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.submitted = 0
+        self.written = 0
+        self.max_depth = 0
+        self.blocked = 0
+        self.blocked_seconds = 0.0
+        self.write_seconds = 0.0
+        self.max_write_seconds = 0.0
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name='chistig-log-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            start = time.perf_counter()
+            try:
+                if self.error is None:
+                    job[0](*job[1:])
+            except BaseException as error:
+                self.error = error
+            elapsed = time.perf_counter() - start
+            self.write_seconds += elapsed
+            self.max_write_seconds = max(self.max_write_seconds, elapsed)
+            self.written += 1
+
+    def _raise(self):
+        if self.error is not None:
+            raise RuntimeError('the background log writer failed') from self.error
+
+    def submit(self, fn, *args):
+        """Queues fn(*args) to run on the writer thread, blocking while the queue is full."""
+        self._raise()
+        if self.queue.full():
+            self.blocked += 1
+            start = time.perf_counter()
+            self.queue.put((fn,) + args)
+            self.blocked_seconds += time.perf_counter() - start
+        else:
+            self.queue.put((fn,) + args)
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def stats(self) -> Dict:
+        return {'queue_depth': self.queue.qsize(), 'max_queue_depth': self.max_depth, 'submitted': self.submitted,
+                'written': self.written, 'blocked': self.blocked, 'blocked_seconds': self.blocked_seconds,
+                'mean_write_seconds': self.write_seconds / max(self.written, 1), 'max_write_seconds': self.max_write_seconds}
+
+    def close(self):
+        """Writes the batches still in the queue and stops the writer thread."""
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        self.queue.put(None)
+        self.thread.join()
+        self._raise()
+
+
+class AsyncTabularLogger(logging.TabularLogger):
+    """TabularLogger that hands the gathered rows to an AsyncLogWriter to be written."""
+
+    def __init__(self, comm: MPI.Intracomm, fpath: str, headers, writer: AsyncLogWriter):
+        super().__init__(comm, fpath, headers)
+        self.writer = writer
+
+    def write(self):
+        rows = self._rows
+        self._rows = []
+        all_items = self._comm.gather(rows, root=0)
+        if self._rank == 0:
+            self.writer.submit(self._write_rows, all_items)
+
+    def _write_rows(self, all_items):
+        with open(self._fpath, 'a', newline='') as fout:
+            writer = csv.writer(fout, delimiter=self._delimiter)
+            for items in all_items:
+                writer.writerows(items)
+
+
+# the columns of the agent log, in the order of the text log
+AGENT_LOG_COLUMNS = ('tick', 'agent_id', 'agent_uid_rank', 'ego_id', 'age', 'age_group', 'race_ethnicity', 'hiv_status',
+                     'relationship_status', 'assigned_eego', 'venues_attended', 'apps_used')
+# the agent log columns that are sets of codes, stored as a <name>_count per row and the flat <name>_codes
+AGENT_LOG_CODE_SETS = ('venues_attended', 'apps_used')
+# the aging of the egos from one weekly tick to the next
+WEEKLY_AGING = 7 / 365
+
+
+def select_log_rows(columns: Dict, rows, prefix: str = '') -> Dict:
+    """Selects the given rows of a dict of agent log columns, in which the code sets are
+    given as a <name>_count and a <name>_codes column, prefixing the column names."""
+    selected = {}
+    for name, column in columns.items():
+        if name.endswith('_codes'):
+            continue
+        selected[prefix + name] = column[rows]
+        if name.endswith('_count'):
+            code_set = name[:-len('_count')]
+            starts = np.cumsum(column) - column
+            selected[prefix + code_set + '_codes'] = columns[code_set + '_codes'][segment_positions(starts[rows], column[rows])]
+    return selected
+
+
+def concatenate_log_parts(parts, columns, dtypes: Dict) -> Dict:
+    """Concatenates the given agent log columns of several parts (e.g. groups or ticks), where
+    each code set column of a part is a tuple of counts and codes, into a dict in which each
+    code set column is a tuple of the row offsets and the flat codes. Without any parts, the
+    columns are empty arrays of the given dtypes (see AgentLogReader.column_dtypes)."""
+    data = {}
+    for name in columns:
+        if name in AGENT_LOG_CODE_SETS:
+            counts = np.concatenate([np.empty(0, dtype=np.int32)] + [part[name][0] for part in parts])
+            offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+            data[name] = (offsets, np.concatenate([np.empty(0, dtype=np.int32)] + [part[name][1] for part in parts]))
+        else:
+            data[name] = np.concatenate([part[name] for part in parts]) if parts else np.empty(0, dtype=dtypes[name])
+    return data
+
+
+def agent_log_delta(previous: Dict, current: Dict, aging) -> Dict:
+    """Returns what changed in the agent log columns from one logged tick to the next, as
+    columns prefixed by the kind of change: 'entry.' for the full rows of the agents that
+    entered, 'exit.agent_id' for the agents that left and, for each column, '<column>.agent_id'
+    and '<column>.value' (or '<column>.count' and '<column>.codes' for the code sets) for the
+    agents whose value changed. Ages only count as changed when they differ from the previous
+    age plus the given aging. The ego ids are left out, as they never change for an agent id.
+    """
+    pos = pd.Index(previous['agent_id']).get_indexer(current['agent_id'])
+    delta = select_log_rows(current, np.flatnonzero(pos < 0), 'entry.')
+    stayed = np.flatnonzero(pos >= 0)
+    pos = pos[stayed]
+    delta['exit.agent_id'] = previous['agent_id'][np.isin(previous['agent_id'], current['agent_id'], invert=True)]
+    for name in AGENT_LOG_COLUMNS[2:]:
+        if name == 'ego_id':
+            continue
+        if name in AGENT_LOG_CODE_SETS:
+            counts, codes = current[name + '_count'], current[name + '_codes']
+            previous_counts, previous_codes = previous[name + '_count'], previous[name + '_codes']
+            changed = counts[stayed] != previous_counts[pos]
+            same = np.flatnonzero(~changed)
+            _counts = counts[stayed[same]]
+            _codes = codes[segment_positions((np.cumsum(counts) - counts)[stayed[same]], _counts)]
+            _previous_codes = previous_codes[segment_positions((np.cumsum(previous_counts) - previous_counts)[pos[same]], _counts)]
+            changed[np.repeat(same, _counts)[_codes != _previous_codes]] = True
+            rows = stayed[changed]
+            delta[name + '.agent_id'] = current['agent_id'][rows]
+            delta[name + '.count'] = counts[rows]
+            delta[name + '.codes'] = codes[segment_positions((np.cumsum(counts) - counts)[rows], counts[rows])]
+        else:
+            expected = previous[name][pos] + np.float32(aging) if name == 'age' else previous[name][pos]
+            rows = stayed[current[name][stayed] != expected]
+            delta[name + '.agent_id'] = current['agent_id'][rows]
+            delta[name + '.value'] = current[name][rows]
+    return delta
+
+
+def apply_agent_log_delta(state: Dict, delta: Dict, aging) -> Dict:
+    """Applies the changes returned by agent_log_delta (split into a dict per kind of change) to
+    the agent log columns of the previous logged tick, returning the columns of the next tick
+    with the entering agents after the agents that stayed."""
+    if 'exit' in delta:
+        state = select_log_rows(state, np.flatnonzero(np.isin(state['agent_id'], delta['exit']['agent_id'], invert=True)))
+    else:
+        state = select_log_rows(state, np.arange(len(state['agent_id'])))
+    state['age'] = state['age'] + np.float32(aging)
+    index = pd.Index(state['agent_id'])
+    for name in AGENT_LOG_COLUMNS[2:]:
+        if name not in delta:
+            continue
+        rows = index.get_indexer(delta[name]['agent_id'])
+        assert((rows >= 0).all())
+        if name in AGENT_LOG_CODE_SETS:
+            # the new sets are appended to the codes, and the changed rows start at them
+            counts = state[name + '_count']
+            starts = np.cumsum(counts) - counts
+            starts[rows] = len(state[name + '_codes']) + np.cumsum(delta[name]['count']) - delta[name]['count']
+            counts[rows] = delta[name]['count']
+            state[name + '_codes'] = np.concatenate([state[name + '_codes'], delta[name]['codes']])[segment_positions(starts, counts)]
+        else:
+            state[name][rows] = delta[name]['value']
+    if 'entry' in delta:
+        state = {name: np.concatenate([column, delta['entry'][name]]) for name, column in state.items()}
+    return state
+
+
+class ColumnarAgentLogger:
+    """Logs the state of the agents into typed columns, as an alternative to the text rows of
+    a TabularLogger: integer ids and codes, float32 ages, and the venues attended and apps
+    used as a per-row count and flat codes. The ego ids are dictionary encoded as the
+    agents are logged, and the labels of all the codes are stored in the file's metadata.
+
+    The logged ticks are buffered on each rank, and every group_ticks ticks they are gathered
+    onto rank 0 and written as one group of rows of a ColumnarLogFile, by the given
+    AsyncLogWriter if any.
+
+    Args:
+        comm: the communicator over which the agents are distributed
+        fname: the name of the log file, or of its first segment when the file already exists (see ColumnarLogFile)
+        labels: the label of each code of the coded columns, by column name
+        group_ticks: the number of ticks written together in a group of rows
+        writer: the AsyncLogWriter that writes the groups, or None to write them in the step
+    """
+
+    FORMAT = 'columnar'
+
+    def __init__(self, comm: MPI.Intracomm, fname: str, labels: Dict, group_ticks: int = 52, writer: AsyncLogWriter = None):
+        self.comm = comm
+        self.rank = comm.Get_rank()
+        self.group_ticks = group_ticks
+        self.writer = writer
+        self.buffer = []
+        self.egoids = []
+        self.egoid_index = {}
+        if self.rank == 0:
+            # the egoids are appended to the ego_id labels as they are first logged
+            self.file = ColumnarLogFile(fname, {'format': self.FORMAT,
+                                                'labels': dict({name: [str(label) for label in column_labels] for name, column_labels in labels.items()}, ego_id=[])})
+
+    def log_tick(self, tick, columns: Dict):
+        """Buffers the rows of one tick, given as a dict with an array per column
+        (for the code sets, a <name>_count and a <name>_codes array) without the tick."""
+        self.buffer.append((tick, columns))
+
+    def write(self):
+        if len(self.buffer) >= self.group_ticks:
+            self.flush()
+
+    def flush(self):
+        buffers = self.comm.gather(self.buffer, root=0)
+        self.buffer = []
+        if self.rank != 0:
+            return
+        if self.writer is not None:
+            self.writer.submit(self.write_group, buffers)
+        else:
+            self.write_group(buffers)
+
+    def write_group(self, buffers):
+        """Writes the ticks gathered from the ranks' buffers as one group of rows."""
+        ticks = sorted([tick_columns for rank_buffer in buffers for tick_columns in rank_buffer], key=lambda tick_columns: tick_columns[0])
+        if len(ticks) == 0:
+            return
+        names = list(dict.fromkeys(name for _, tick_columns in ticks for name in tick_columns))
+        columns = {name: np.concatenate([tick_columns[name] for _, tick_columns in ticks if name in tick_columns]) for name in names}
+        # a tick column for the rows of each prefix (no prefix for the rows of the plain log)
+        for prefix in dict.fromkeys(name[:-len('agent_id')] for name in names if name.endswith('agent_id')):
+            _ticks = [(tick, len(tick_columns[prefix + 'agent_id'])) for tick, tick_columns in ticks if prefix + 'agent_id' in tick_columns]
+            columns[prefix + 'tick'] = np.repeat(np.array([tick for tick, _ in _ticks], dtype=np.int32), [rows for _, rows in _ticks])
+        _known = len(self.egoids)
+        for name in names:
+            if name == 'ego_id' or name.endswith('.ego_id'):
+                columns[name] = self.encode_egoids(columns[name])
+        # the egoids first seen in the group are appended to the ego_id labels with the group
+        self.file.write_group(columns, labels={'ego_id': self.egoids[_known:]}, tick_min=float(ticks[0][0]), tick_max=float(ticks[-1][0]),
+                              ticks=sorted(set(float(tick) for tick, _ in ticks)), **self.group_info(ticks))
+
+    def group_info(self, ticks) -> Dict:
+        return {}
+
+    def encode_egoids(self, egoids) -> np.ndarray:
+        for egoid in pd.unique(egoids):
+            if egoid not in self.egoid_index:
+                self.egoid_index[egoid] = len(self.egoids)
+                self.egoids.append(egoid)
+        return pd.Index(self.egoids).get_indexer(egoids).astype(np.int32)
+
+    def close(self):
+        self.flush()
+        if self.rank == 0:
+            if self.writer is not None:
+                self.writer.submit(self.file.close)
+            else:
+                self.file.close()
+
+
+class DeltaAgentLogger(ColumnarAgentLogger):
+    """Columnar agent logger that writes the full state of the agents as a keyframe every
+    keyframe_ticks logged ticks and, in between, only what changed since the previous logged
+    tick (see agent_log_delta): entries, exits, HIV conversions, age group changes,
+    relationship flips, new venue and app sets and so on.
+
+    Args:
+        comm, fname, labels, group_ticks, writer: as for ColumnarAgentLogger
+        keyframe_ticks: the number of logged ticks from one keyframe to the next
+    """
+
+    FORMAT = 'delta'
+
+    def __init__(self, comm: MPI.Intracomm, fname: str, labels: Dict, group_ticks: int = 52, keyframe_ticks: int = 52,
+                 writer: AsyncLogWriter = None):
+        super().__init__(comm, fname, labels, group_ticks, writer)
+        self.keyframe_ticks = keyframe_ticks
+        self.logged = 0
+        self.previous = None
+
+    def log_tick(self, tick, columns: Dict):
+        if self.logged % self.keyframe_ticks == 0:
+            delta = {'key.' + name: column for name, column in columns.items()}
+        else:
+            previous_tick, previous_columns = self.previous
+            delta = agent_log_delta(previous_columns, columns, (tick - previous_tick) * WEEKLY_AGING)
+        self.previous = (tick, columns)
+        self.logged += 1
+        super().log_tick(tick, delta)
+
+    def group_info(self, ticks) -> Dict:
+        return {'keyframes': sorted(set(float(tick) for tick, tick_columns in ticks if 'key.agent_id' in tick_columns))}
+
+
+class AgentLogReader(ColumnarLogReader):
+    """Reads a ColumnarAgentLogger log by tick range and column."""
+
+    def read(self, ticks=None, columns=None) -> Dict:
+        """Reads the given columns (or all AGENT_LOG_COLUMNS) of the rows of the ticks in
+        the (first, last) range (or all ticks).
+
+        Returns:
+            A dict of the coded columns, where each code set column is a tuple of the row
+            offsets and the flat codes (see obtain_venue_attendance_codes), and the
+            labels of the codes are in the reader's metadata['labels'].
+        """
+        columns = AGENT_LOG_COLUMNS if columns is None else columns
+        stored = {'tick'}
+        for name in columns:
+            stored.update((name + '_count', name + '_codes') if name in AGENT_LOG_CODE_SETS else (name,))
+        parts = []
+        for group in self.select(ticks):
+            arrays = self.read_group(group, stored)
+            keep = np.ones(len(arrays['tick']), dtype=np.bool_)
+            if ticks is not None:
+                keep = (arrays['tick'] >= ticks[0]) & (arrays['tick'] <= ticks[1])
+            arrays = select_log_rows(arrays, np.flatnonzero(keep))
+            parts.append({name: (arrays[name + '_count'], arrays[name + '_codes']) if name in AGENT_LOG_CODE_SETS else arrays[name]
+                          for name in columns})
+        return concatenate_log_parts(parts, columns, self.column_dtypes())
+
+    def column_dtypes(self) -> Dict:
+        """Returns the dtype each agent log column is stored with (in the delta log, as in the
+        keyframes and entries), or int32 codes and float32 ages if the log has no groups."""
+        dtypes = {name: np.dtype(np.float32 if name == 'age' else np.int32) for name in AGENT_LOG_COLUMNS}
+        for group in self.groups:
+            for name, (_, _, dtype, _) in group['columns'].items():
+                name = name.split('.', 1)[1] if name.startswith(('key.', 'entry.')) else name
+                if name in dtypes:
+                    dtypes[name] = np.dtype(dtype)
+        return dtypes
+
+    def frame(self, ticks=None, columns=None) -> pd.DataFrame:
+        """Reads the given columns of the given ticks like read, decoded into a DataFrame
+        with the labels and '|'-joined sets of the text agent log."""
+        columns = AGENT_LOG_COLUMNS if columns is None else columns
+        data = self.read(ticks, list(dict.fromkeys(list(columns) + (['ego_id'] if set(columns) & set(AGENT_LOG_CODE_SETS) else []))))
+        labels = {name: np.array(column_labels, dtype=object) for name, column_labels in self.metadata['labels'].items()}
+        egoids = labels['ego_id'][data['ego_id']] if 'ego_id' in data else None
+        decoded = {}
+        for name in columns:
+            if name in AGENT_LOG_CODE_SETS:
+                decoded[name] = join_label_rows(labels[name], *data[name], egoids)
+            elif name in labels:
+                decoded[name] = labels[name][data[name]]
+            else:
+                decoded[name] = data[name]
+        return pd.DataFrame(decoded)
+
+
+class DeltaAgentLogReader(AgentLogReader):
+    """Reads a DeltaAgentLogger log, reconstructing the state of the agents at each logged
+    tick from the last keyframe before it and the changes logged since."""
+
+    def read(self, ticks=None, columns=None) -> Dict:
+        """Reconstructs the given columns of the logged ticks in the (first, last) range (or
+        all ticks), returned like AgentLogReader.read."""
+        columns = AGENT_LOG_COLUMNS if columns is None else columns
+        logged = sorted(tick for group in self.groups for tick in group['ticks'])
+        if ticks is not None:
+            logged = [tick for tick in logged if ticks[0] <= tick <= ticks[1]]
+        parts = []
+        for tick, state in self.states(logged):
+            state = dict(state, tick=np.full(len(state['agent_id']), tick, dtype=np.int32))
+            parts.append({name: (state[name + '_count'], state[name + '_codes']) if name in AGENT_LOG_CODE_SETS else state[name]
+                          for name in columns})
+        return concatenate_log_parts(parts, columns, self.column_dtypes())
+
+    def states(self, ticks):
+        """Yields (tick, columns) for each of the given logged ticks in order, where columns
+        has the code sets as <name>_count and <name>_codes columns, as they were logged."""
+        if len(ticks) == 0:
+            return
+        ticks = sorted(ticks)
+        start = max(tick for group in self.groups for tick in group['keyframes'] if tick <= ticks[0])
+        changes = self.changes((start, ticks[-1]))
+        wanted = set(ticks)
+        state = None
+        for tick in sorted(changes):
+            if 'key' in changes[tick]:
+                state = changes[tick]['key']
+            else:
+                state = apply_agent_log_delta(state, changes[tick], (tick - previous_tick) * WEEKLY_AGING)
+            previous_tick = tick
+            if tick in wanted:
+                yield tick, state
+
+    def changes(self, ticks) -> Dict:
+        """Reads the keyframes and changes logged in the (first, last) tick range, as a
+        dict of tick -> kind of change -> columns, e.g. changes[tick]['hiv_status']['value']."""
+        changes = {tick: {} for group in self.select(ticks) for tick in group['ticks'] if ticks[0] <= tick <= ticks[1]}
+        for group in self.select(ticks):
+            arrays = self.read_group(group)
+            for prefix in dict.fromkeys(name.split('.')[0] for name in arrays):
+                columns = {name[len(prefix) + 1:]: column for name, column in arrays.items() if name.startswith(prefix + '.')}
+                _ticks = columns.pop('tick')
+                # the code sets of the changes are stored as count and codes
+                code_set = {'count': 'codes'} if 'count' in columns else {}
+                code_set.update((name, name[:-len('_count')] + '_codes') for name in columns if name.endswith('_count'))
+                starts = {name: np.cumsum(columns[name]) - columns[name] for name in code_set}
+                for tick in np.unique(_ticks).tolist():
+                    if not ticks[0] <= tick <= ticks[1]:
+                        continue
+                    rows = np.flatnonzero(_ticks == tick)
+                    tick_columns = {name: column[rows] for name, column in columns.items() if name not in code_set.values()}
+                    for count, codes in code_set.items():
+                        tick_columns[codes] = columns[codes][segment_positions(starts[count][rows], columns[count][rows])]
+                    changes[tick][prefix] = tick_columns
+        return changes
+
+
+# the levels of the event stream from the least to the most severe, 'none' turns recording or printing off
+EVENT_LEVELS = ('debug', 'info', 'warning', 'none')
+# the events of the event stream and their levels. The value of an event is the democode of the entering
+# ego, the new age group of the aged ego or the code of the capped venue (with an agent of -1), and 0 otherwise
+EVENT_TYPES = (('entered', 'debug'), ('left', 'debug'), ('aged', 'debug'), ('hiv_positive', 'debug'),
+               ('hiv_status_error', 'warning'), ('venue_capped', 'warning'))
+
+
+class EventLog:
+    """Stream of the model's events (e.g. egos entering or leaving the simulation) with levels.
+
+    Every event is counted in memory. Events at or above the record level are also written
+    to a binary event file of typed records (tick, agent, event, value), if one is given, and
+    events and messages at or above the print level are printed as text. The text of an event
+    is only formatted when it is printed, so by default the events cost no more than their
+    counting and recording.
+
+    Layout of the event file: MAGIC, the header length as a little endian uint32, a JSON header
+    with the names of the events and the record dtype, then the records, so that the file can
+    be read up to its last complete record even if the run stopped early, see read_events. An
+    existing event file is never overwritten: the events go to the next free file name (see fname).
+    """
+
+    MAGIC = b'CHSTGEVT'
+    RECORD = np.dtype([('tick', '<i4'), ('agent', '<i8'), ('event', 'u1'), ('value', '<i4')])
+
+    def __init__(self, fname: str = '', record_level: str = 'debug', print_level: str = 'warning', buffer_size: int = 65536):
+        self.names = tuple(name for name, _ in EVENT_TYPES)
+        self.levels = [EVENT_LEVELS.index(level) for _, level in EVENT_TYPES]
+        self.record_level = EVENT_LEVELS.index(record_level)
+        self.print_level = EVENT_LEVELS.index(print_level)
+        self.counts = np.zeros(len(EVENT_TYPES), dtype=np.int64)
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        self.file = None
+        self.fname = ''
+        if fname:
+            header = json.dumps({'events': self.names, 'levels': [level for _, level in EVENT_TYPES], 'record': EventLog.RECORD.descr}).encode()
+            # e.g. events_1.bin when events.bin was written by an earlier segment of the run
+            self.fname = str(util.find_free_filename(fname))
+            os.makedirs(os.path.dirname(os.path.abspath(self.fname)), exist_ok=True)
+            self.file = open(self.fname, 'wb')
+            self.file.write(EventLog.MAGIC)
+            self.file.write(struct.pack('<I', len(header)))
+            self.file.write(header)
+
+    def record(self, event: str, tick, agents, values=0, describe=None):
+        """Records the event for each of the given agents (their numeric ids) at the tick.
+
+        Args:
+            event: the name of the event, see EVENT_TYPES
+            tick: the tick of the event
+            agents: the numeric ids of the agents
+            values: the value of the event for each agent, or one value for all
+            describe: called only if the event is printed, returns the text line of each agent
+        """
+        code = self.names.index(event)
+        agents = np.asarray(agents, dtype=np.int64)
+        self.counts[code] += len(agents)
+        if len(agents) == 0:
+            return
+        level = self.levels[code]
+        if self.file is not None and level >= self.record_level:
+            records = np.empty(len(agents), dtype=EventLog.RECORD)
+            records['tick'] = tick
+            records['agent'] = agents
+            records['event'] = code
+            records['value'] = values
+            self.buffer.append(records)
+            self.buffered += len(records)
+            if self.buffered >= self.buffer_size:
+                self.flush()
+        if level >= self.print_level and describe is not None:
+            print('\n'.join(describe()))
+
+    def message(self, level: str, text: str):
+        # messages are only printed, e.g. the progress of the simulation at 'info'
+        if EVENT_LEVELS.index(level) >= self.print_level:
+            print(text)
+
+    def summary(self) -> Dict:
+        # the number of events of each type since the event log was created
+        return dict(zip(self.names, self.counts.tolist()))
+
+    def flush(self):
+        if self.file is not None and self.buffer:
+            self.file.write(np.concatenate(self.buffer).tobytes())
+            self.file.flush()
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+
+def read_events(fname: str) -> pd.DataFrame:
+    """Reads the records of an event file written by EventLog, with the events as a categorical
+    of their names."""
+    with open(fname, 'rb') as f:
+        assert(f.read(len(EventLog.MAGIC)) == EventLog.MAGIC), f'{fname} is not an event file'
+        (length,) = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(length))
+    record = np.dtype([tuple(field) for field in header['record']])
+    offset = len(EventLog.MAGIC) + 4 + length
+    records = np.fromfile(fname, dtype=record, count=(os.path.getsize(fname) - offset) // record.itemsize, offset=offset)
+    events = pd.DataFrame(records)
+    events['event'] = pd.Categorical.from_codes(events['event'], header['events'])
+    return events
+
+
+# the params that compile_param_tables turns into arrays
+PARAM_TABLES = ('venue.types', 'app.types', 'empop.demo.buckets', 'empop.demo.rel.buckets', 'empop.app.use', 'empop.venue.attendance')
+# bumped when the compiled tables change, so older compiled params are rebuilt
+COMPILED_PARAMS_VERSION = 1
+
+
+def compile_param_tables(params: Dict) -> Dict:
+    """Compiles the empirical tables of the params (the '|'-joined venue and app types, demo
+    buckets and appuse, and the nested venue attendance dict) into integer coded arrays.
+
+    Returns:
+        A dict of the eego, venue and app labels, the attendance matrix in CSR layout with its
+        daily and weekly probabilities, the demo buckets and the appuse in CSR layout, and the
+        dating lookups of the venues and apps.
+    """
+    # create an object that is the venues and their venue type
+    venue_types = {key: value.split('|') for key, value in params['venue.types'].items()}
+    venues_dating = venue_types['bar-club'] + venue_types['bathhouse']
+    venues_nondating = venue_types['arts-theatre'] + venue_types['communityorganization'] + venue_types['museum-library-attraction-casino'] + venue_types['park-neighborhood'] + venue_types['restaurant-coffeeshop'] + venue_types['school-college-university'] + venue_types['shopping'] + venue_types['somethingelse'] + venue_types['sports-gamingvenue']
+
+    # create an object that is the apps and their app type
+    app_types = {key: value.split('|') for key, value in params['app.types'].items()}
+    apps_dating = app_types['classifiedandescort'] + app_types['hookup-datingapp']
+    apps_nondating = app_types['socialnetwork']
+
+    demo_buckets = {int(key): value.split('|') for key, value in params['empop.demo.buckets'].items()}
+
+    # compile empirical egos and their venue attendance into a sparse matrix
+    attendance, eego_labels, venue_labels = build_attendance_matrix(
+        params['empop.venue.attendance'],
+        [thisvenue for thisvenues in venue_types.values() for thisvenue in thisvenues],
+        [thiseego for thiseegos in demo_buckets.values() for thiseego in thiseegos])
+    eego_index = {thiseego: row for row, thiseego in enumerate(eego_labels)}
+    venue_index = {thisvenue: col for col, thisvenue in enumerate(venue_labels)}
+    eego_labels = np.array(eego_labels, dtype=object)
+
+    # the demo buckets as empirical ego codes in CSR layout (row = democode)
+    demo_bucket_indptr = np.zeros(max(demo_buckets) + 2, dtype=np.int64)
+    for key, value in demo_buckets.items():
+        demo_bucket_indptr[key + 1] = len(value)
+    np.cumsum(demo_bucket_indptr, out=demo_bucket_indptr)
+    demo_bucket_eegos = np.concatenate([np.array([eego_index[thiseego] for thiseego in demo_buckets[key]], dtype=np.int32) for key in sorted(demo_buckets)])
+
+    # the appslist of the empirical egos as app codes in CSR layout (row = empirical ego)
+    app_labels = np.array(clean_venue_list([thisapp for thisapps in app_types.values() for thisapp in thisapps]
+                                           + [thisapp for thisapps in params['empop.app.use'].values() for thisapp in thisapps.split('|')]), dtype=object)
+    app_index = {thisapp: code for code, thisapp in enumerate(app_labels)}
+    eego_app_indptr, eego_app_codes = encode_label_lists(params['empop.app.use'], eego_labels, app_index)
+
+    return {'eego_labels': eego_labels,
+            'venue_labels': np.array(venue_labels, dtype=object),
+            'app_labels': app_labels,
+            'attendance_indptr': attendance.indptr,
+            'attendance_indices': attendance.indices,
+            'attendance_data': attendance.data,
+            'attendance_weekly_probs': weekly_attendance_prob(attendance.data).astype(np.float32),
+            'demo_bucket_indptr': demo_bucket_indptr,
+            'demo_bucket_eegos': demo_bucket_eegos,
+            'eego_app_indptr': eego_app_indptr,
+            'eego_app_codes': eego_app_codes,
+            'venue_is_dating': dating_lookup(venue_index, venues_dating, venues_nondating),
+            'app_is_dating': dating_lookup(app_index, apps_dating, apps_nondating)}
+
+
+def load_param_tables(compiled_dir: str) -> Dict:
+    """Loads the compiled param tables, memory mapping the arrays (the labels are small and are read into object arrays)."""
+    tables = {}
+    for fname in os.listdir(compiled_dir):
+        name, extension = os.path.splitext(fname)
+        if extension == '.npy':
+            tables[name] = np.load(os.path.join(compiled_dir, fname), mmap_mode='r')
+            if name.endswith('_labels'):
+                tables[name] = tables[name].astype(object)
+    return tables
+
+
+def compile_params(parameters_file: str) -> Dict:
+    """Returns the params of the yaml parameters file without the tables in PARAM_TABLES, whose
+    compiled arrays (see compile_param_tables) are stored next to the yaml, in a directory
+    named after the hash of its content, and found by the model through 'params.compiled.dir'.
+
+    The yaml is only parsed and compiled when its compiled params are not there yet, so later runs
+    load the params json and memory map the arrays. If the compiled params cannot be written, the
+    full params are returned as by repast4py's init_params.
+    """
+    compiled_dir = os.path.join(os.path.abspath(parameters_file) + '.compiled', f'{file_hash(parameters_file)[:16]}.v{COMPILED_PARAMS_VERSION}')
+    if not os.path.exists(os.path.join(compiled_dir, 'params.json')):
+        _params = parameters.init_params(parameters_file, '')
+        try:
+            # compiled into a temporary directory first, as concurrent runs may be compiling the same yaml
+            temporary = f'{compiled_dir}.{os.getpid()}.tmp'
+            os.makedirs(temporary, exist_ok=True)
+            for name, table in compile_param_tables(_params).items():
+                np.save(os.path.join(temporary, name + '.npy'), table.astype(str) if table.dtype == object else table)
+            with open(os.path.join(temporary, 'params.json'), 'w') as f:
+                json.dump({key: value for key, value in _params.items() if key not in PARAM_TABLES}, f)
+            try:
+                os.rename(temporary, compiled_dir)
+            except OSError:
+                if not os.path.exists(os.path.join(compiled_dir, 'params.json')):
+                    raise
+                shutil.rmtree(temporary, ignore_errors=True)
+        except OSError:
+            return _params
+    with open(os.path.join(compiled_dir, 'params.json')) as f:
+        _params = json.load(f)
+    if 'random.seed' in _params:
+        init_random(_params['random.seed'])
+    _params['params.compiled.dir'] = compiled_dir
+    return _params
+
+
 model = None
 
-# @dataclass 
-# class Counts:
-#     """Dataclass used by repast4py aggregate logging to record
-#     the number of egos in each demographic group after each tick.
-#     """
-#     egos: int=0
-#     # blackNH20under: int = 0
-#     # blackNH21over: int = 0
-#     # whiteNH20under: int = 0
-#     # whiteNH21over: int = 0
-#     # otherNH20under: int = 0
-#     # otherNH21over: int = 0
-#     # latinx20under: int = 0
-#     # latinx21over: int = 0
+@dataclass 
+class Counts:
+    """Dataclass used by repast4py aggregate logging to record
+    the number of egos in each demographic group after each tick,
+    and the totals of their venue attendance, appuse, HIV and relationship status 
+    (the mean venues attended is venues_attended / egos).
+    """
+    egos: int = 0
+    whiteNH20under: int = 0
+    whiteNH21over: int = 0
+    blackNH20under: int = 0
+    blackNH21over: int = 0
+    latinx20under: int = 0
+    latinx21over: int = 0
+    otherNH20under: int = 0
+    otherNH21over: int = 0
+    venues_attended: int = 0
+    venue_attenders: int = 0
+    dating_venue_attenders: int = 0
+    app_users: int = 0
+    dating_app_users: int = 0
+    hiv_positive: int = 0
+    in_relationship: int = 0
+
+# the Counts field of each democode
+DEMOCODE_COUNTS = ('whiteNH20under', 'whiteNH21over', 'blackNH20under', 'blackNH21over',
+                   'latinx20under', 'latinx21over', 'otherNH20under', 'otherNH21over')
 
 class Ego(core.Agent):
     """The Synthetic Ego Agent
 
+    The state of the ego is stored in its row of the columnar agent_table, so an
+    Ego is a thin view with no instance attributes of its own.
+
     Args:
         a_id: a integer that uniquely identifies this Ego on its
               starting rank
@@ -52,26 +1602,34 @@ class Ego(core.Agent):
         age: age of the agent, where age is year plus number of days (where each day is 1/365) -- NOTE: is updated EACH timestep
         raceethnicity: raceethnicity group of agent -- NOTE: will NOT change
         agegroup: age group of agent -- NOTE: this can change as ego ages into the older age group
-        eego_venues: the empirical ego used to assigne venue attendance -- NOTE: can change based on age group change
+        eego: the code of the empirical ego used to assign venue attendance and appuse -- NOTE: can change based on age group change
         relationshipstatus: relationship status of ego agent -- NOTE: is updated EACH time step
         hiv_status: the hiv status of the agent 
+        venues_attended: sorted codes of the venues attended during the current week
+        apps_used: sorted codes of the apps used during the current week
 
     """
 
     TYPE = 0
 
+    __slots__ = ()
+
+    egoid = _TableColumn('egoid', str)
+    age = _TableColumn('age', float)
+    agegroup = _TableColumn('agegroup', labels=AGE_GROUPS)
+    raceethnicity = _TableColumn('raceethnicity', labels=RACE_ETHNICITIES)
+    democode = _TableColumn('democode', int)
+    hivstatus = _TableColumn('hivstatus', int)
+    relationshipstatus = _TableColumn('relationshipstatus', int)
+    eego = _TableColumn('eego', int)
+    venues_attended = _TableCodes('venues')
+    apps_used = _TableCodes('apps')
+
     def __init__(self, ego_id: int, rank: int):
         super().__init__(id=ego_id, type=Ego.TYPE, rank=rank)
-        self.egoid = 's' + str(ego_id).zfill(5)
-        self.age = 16.0 #0/365
-        self.agegroup = '16to20' #16to20, 21to20 
-        self.raceethnicity = 'blackNH' #blackNH, whiteNH, otherNH, hispanic
-        self.democode = 1
-        self.hivstatus = 0
-        self.relationshipstatus = 0
-        self.eego = 'e001'
-        self.venues_attended = 's' + str(ego_id).zfill(5)
-        self.apps_used = 's' + str(ego_id).zfill(5)
+        # a new ego starts from the default state, unless its row was already added in bulk
+        if not agent_table.contains(ego_id):
+            agent_table.add(ego_id, rank)
 
     def save(self) -> Tuple:
         """Saves the state of this Ego as a Tuple.
@@ -81,7 +1639,7 @@ class Ego(core.Agent):
         """
         return (self.uid,
                 self.egoid, self.age, self.agegroup, self.raceethnicity, self.democode, self.hivstatus, self.relationshipstatus,
-                self.eego, self.venues_attended, self.apps_used)
+                self.eego, self.venues_attended.copy(), self.apps_used.copy(), agent_table.replicate_state(agent_table.view_row(self.id)))
 
 
 agent_cache = {}
@@ -105,6 +1663,8 @@ def restore_agent(agent_data: Tuple):
     # 0 is id, 1 is type, 2 is rank
     if uid in agent_cache:
         sego = agent_cache[uid]
+        if not agent_table.contains(uid[0]):
+            agent_table.add(uid[0], uid[2])
     else:
         sego = Ego(uid[0], uid[2])
         agent_cache[uid] = sego
@@ -120,6 +1680,7 @@ def restore_agent(agent_data: Tuple):
     sego.eego = agent_data[8]
     sego.venues_attended = agent_data[9]
     sego.apps_used = agent_data[10]
+    agent_table.set_replicate_state(agent_table.id2row[uid[0]], agent_data[11])
     return sego
 
         
@@ -142,6 +1703,17 @@ class Model:
         self.comm = comm
         self.context = ctx.SharedContext(comm)
         self.rank = self.comm.Get_rank()
+        self.size = self.comm.Get_size()
+        # the ownership directory: the rank that owns each numeric id whose ego was moved by a rebalance, 
+        # and -1 for the others, see owner. It is the same on every rank
+        self.directory = np.full(0, -1, dtype=np.int32)
+        # the egos are rebalanced across the ranks every rebalance.interval ticks (0 for never), if the 
+        # most loaded rank has more than rebalance.threshold above the mean number of egos
+        self.rebalance_interval = int(params.get('rebalance.interval', 0))
+        self.rebalance_threshold = float(params.get('rebalance.threshold', 0.1))
+        self.rebalance_batch_size = int(params.get('rebalance.batch.size', 10000))
+        self.rebalances = []
+        self.step_time = 0.0
         
         # create the schedule
         self.runner = schedule.init_schedule_runner(comm)
@@ -159,102 +1731,330 @@ class Model:
         #     # but for now do it explicitly here
         #     random.init(int(time.time()))
 
-        # initialize Tabular logging 
-        self.agent_logger = logging.TabularLogger(comm, params['agent.log.file'], ['tick', 'agent_id', 'agent_uid_rank', 'ego_id', 'age', 'age_group', 'race_ethnicity', 'hiv_status', 'relationship_status', 'assigned_eego', 'venues_attended', 'apps_used'])
+        # the egos' state lives in the columnar agent table, of which the Ego agents are views.
+        # With replicates, the empirical egos, venues and apps of the replicates are drawn from their own
+        # streams for the same population, see seed_replicates
+        self.replicates = int(params.get('replicates', 1))
+        agent_table.set_replicates(self.replicates)
+        self.table = agent_table
+        self.seed_replicates()
 
         # print(MPI.Comm.Get_size(self.comm))
 
-        sego_datafile = params['synthpop.ego.file']
-        segodf = pd.read_csv(sego_datafile)
-
-        self.egoidcounter = 1
-        for index, row in segodf.iterrows():
-            sego = Ego(row['numeric_id'], self.rank)
-            sego.egoid = row['egoid']
-            sego.age = row['age']
-            sego.agegroup = row['agegroup']
-            sego.raceethnicity = row['race_ethnicity']
-            sego.democode = row['demographic_bucket']
-            # sego.hivstatus = 0
-            sego.hivstatus = row['hiv_status']
-            sego.relationshipstatus = int(row['any_serious'])
-            sego.eego = row['assigned_empego']
-            sego.venues_attended = row['egoid']
-            sego.apps_used = row['egoid']
-            self.context.add(sego)
-            self.egoidcounter += 1
-
-
-        # create an object for empirical egos and their demo buckets
-        self.empop_demo_buckets = {key: value.split('|') for key, value in params['empop.demo.buckets'].items()}
-
-        # create an object for empirical egos and their venue assignment
-        self.empop_venue_attendance_dict = params['empop.venue.attendance']
-
-        # create an object for empirical egos and their appslist 
-        self.empop_appuse_dict = params['empop.app.use']
+        # the empirical egos' demo buckets, venue attendance and appuse and the venue and app types,
+        # compiled into integer coded arrays (or loaded from the compiled params, see compile_params).
+        # Venues, apps and empirical egos are carried around as integer codes, which
+        # are assigned in the natural order of their ids (so sorted codes are in natural order),
+        # and only turned back into their ids when exported to R or logged.
+        # The compiled tables are published once per node in shared.data.dir, where all the runs of the node map them
+        shared_dir = params.get('shared.data.dir', '')
+        if 'params.compiled.dir' in params:
+            compiled_dir = params['params.compiled.dir']
+            if shared_dir:
+                compiled_dir = publish_shared_arrays(shared_dir, f'params.{os.path.basename(compiled_dir)}', lambda: load_param_tables(compiled_dir)) or compiled_dir
+            tables = load_param_tables(compiled_dir)
+        else:
+            tables = compile_param_tables(params)
+        self.eego_labels = tables['eego_labels']
+        self.venue_labels = tables['venue_labels']
+        self.app_labels = tables['app_labels']
+
+        # empirical egos and their venue attendance as a sparse matrix
+        # (row = empirical ego, column = venue, data = daily attendance frequency)
+        self.eego_venue_matrix = sparse.csr_matrix((tables['attendance_data'], tables['attendance_indices'], tables['attendance_indptr']),
+                                                   shape=(len(self.eego_labels), len(self.venue_labels)))
+        # weekly probability of attending at least once for each stored entry of the matrix
+        self.eego_weekly_probs = tables['attendance_weekly_probs']
+
+        # venue attendance is drawn for the whole population at once ('vectorized'),
+        # or day by day for each ego as in the original model ('scalar')
+        self.attendance_mode = params.get('attendance.mode', 'vectorized')
+        assert(self.attendance_mode in ('vectorized', 'scalar'))
+        assert(self.attendance_mode == 'vectorized' or self.replicates == 1)
+        # the draws come from repast4py's default_rng in the order the egos are drawn for ('sequential'),
+        # or are keyed by (seed, purpose, tick, numeric id) ('counter'), which gives the same draws in either 
+        # attendance mode and on any number of ranks
+        self.random_streams = params.get('random.streams', 'sequential')
+        assert(self.random_streams in ('sequential', 'counter'))
+        self.colocation_venue_cap = int(params.get('colocation.venue.cap', 0))
+
+        # empirical egos of each demo bucket in CSR layout (row = democode) for drawing whole batches of egos at once,
+        # and the same buckets by democode
+        self.demo_bucket_indptr = tables['demo_bucket_indptr']
+        self.demo_bucket_eegos = tables['demo_bucket_eegos']
+        self.empop_demo_buckets = {democode: self.demo_bucket_eegos[start:end] for democode, (start, end)
+                                   in enumerate(zip(self.demo_bucket_indptr[:-1].tolist(), self.demo_bucket_indptr[1:].tolist())) if end > start}
+
+        # empirical egos and their appslist, as app codes in CSR layout (row = empirical ego)
+        self.eego_app_indptr = tables['eego_app_indptr']
+        self.eego_app_codes = tables['eego_app_codes']
+
+        # dating / nondating lookups indexed by venue and app code
+        self.venue_is_dating = tables['venue_is_dating']
+        self.app_is_dating = tables['app_is_dating']
+
+        # the agent log is written by Tabular logging, or as the columnar binary log (of every tick or of the
+        # changes between keyframes), or not at all when only the counts are needed
+        self.params = params
+        # the index of the replicate in a child forked by fork_replicates
+        self.replicate = None
+        self.agent_log_format = params.get('agent.log.format', 'text')
+        assert(self.agent_log_format in ('text', 'columnar', 'delta', 'none'))
+        self.counts = Counts()
+        self.open_logs(params['agent.log.file'], params.get('counts.log.file', ''), params.get('events.file', ''))
 
         # create an object for empirical egos and their relationship status within demo buckets   
         # self.empop_demo_rel_buckets = {outer_key: {inner_key: inner_value.split('|') if isinstance(inner_value, str) else inner_value for inner_key, inner_value in outer_value.items()} for outer_key, outer_value in params['empop.demo.rel.buckets'].items()}
 
-        # create an object that is the venues and their venue type
-        self.venue_types = {key: value.split('|') for key, value in params['venue.types'].items()}
-        self.venues_dating = self.venue_types['bar-club'] + self.venue_types['bathhouse']
-        self.venues_nondating = self.venue_types['arts-theatre'] + self.venue_types['communityorganization'] + self.venue_types['museum-library-attraction-casino'] + self.venue_types['park-neighborhood'] + self.venue_types['restaurant-coffeeshop'] + self.venue_types['school-college-university'] + self.venue_types['shopping'] + self.venue_types['somethingelse'] + self.venue_types['sports-gamingvenue']
-
-        # create an object that is the apps and their app type
-        self.app_types = {key: value.split('|') for key, value in params['app.types'].items()}
-        self.apps_dating = self.app_types['classifiedandescort'] + self.app_types['hookup-datingapp']
-        self.apps_nondating = self.app_types['socialnetwork']
-
-
+        sego_datafile = params['synthpop.ego.file']
+        published = publish_shared_arrays(shared_dir, f'synthpop.{file_hash(sego_datafile)[:16]}.v{SYNTHPOP_SNAPSHOT_VERSION}',
+                                          lambda: load_synthpop(sego_datafile, params.get('synthpop.cache.dir', ''))) if shared_dir else ''
+        if published:
+            # the initial population is copied from the node's shared population into the agent table
+            segos = load_shared_arrays(published)
+        else:
+            segos = load_synthpop(sego_datafile, params.get('synthpop.cache.dir', ''))
+        self.egoidcounter = 1 + len(segos['numeric_id'])
+
+        # each rank only adds the egos it owns (see owner)
+        _owned = np.flatnonzero(self.owner(segos['numeric_id']) == self.rank)
+        segos = {name: column[_owned] for name, column in segos.items()}
+        self.table.extend(segos['numeric_id'], self.rank,
+                          egoid=segos['egoid'],
+                          age=segos['age'],
+                          agegroup=segos['agegroup'],
+                          raceethnicity=segos['raceethnicity'],
+                          democode=segos['democode'],
+                          hivstatus=segos['hivstatus'],
+                          relationshipstatus=segos['relationshipstatus'],
+                          eego=encode_labels(segos['assigned_empego'], self.eego_labels))
+        for numericid in segos['numeric_id'].tolist():
+            self.context.add(Ego(numericid, self.rank))
+
+
+
+    def seed_replicates(self):
+        """Seeds the stream of each replicate after the first from the seed of repast4py's
+        default_rng (the stream of replicate 0): replicate k draws as a run seeded k times the
+        number of ranks after the model's seed would."""
+        self.replicate_rngs = [np.random.default_rng(random.seed + replicate * self.size) for replicate in range(1, self.replicates)]
+
+    def rng(self, replicate: int, purpose: str):
+        """Returns what the given replicate draws the purpose (one of STREAM_PURPOSES) from: repast4py's
+        default_rng or the replicate's generator with sequential streams, or with counter streams the 
+        replicate's counter stream for the current tick, keyed by the stream seed plus the replicate."""
+        if self.random_streams == 'counter':
+            return CounterStream(stream_seed + replicate, purpose, self.runner.schedule.tick)
+        return random.default_rng if replicate == 0 else self.replicate_rngs[replicate - 1]
+
+    def draw_eego(self, numericid: int, democode: int) -> int:
+        # the empirical ego of a single ego from its demo bucket (the reference mode)
+        if self.random_streams == 'counter':
+            return int(draw_bucket_members(self.demo_bucket_indptr, self.demo_bucket_eegos, [democode], self.rng(0, 'eego'), [numericid])[0])
+        return int(random.default_rng.choice(self.empop_demo_buckets[democode]))
+
+    def owner(self, numeric_ids) -> np.ndarray:
+        """Returns the rank that owns each of the egos with the given numeric ids: the egos
+        are partitioned across the ranks by their numeric id modulo the number of ranks, 
+        except for the egos moved by a rebalance, whose rank is in the ownership directory."""
+        numeric_ids = np.atleast_1d(np.asarray(numeric_ids, dtype=np.int64))
+        owners = numeric_ids % self.size
+        moved = np.flatnonzero(numeric_ids < len(self.directory))
+        moved = moved[self.directory[numeric_ids[moved]] >= 0]
+        owners[moved] = self.directory[numeric_ids[moved]]
+        return owners
+
+    def owned(self, numeric_ids) -> np.ndarray:
+        # the positions of the given numeric ids owned by this rank
+        return np.flatnonzero(self.owner(numeric_ids) == self.rank)
+
+    def agent(self, numeric_id: int) -> Ego:
+        # the Ego of a numeric id on this rank, found through the uid rank in the agent table
+        return self.context.agent((numeric_id, Ego.TYPE, int(self.table.uid_rank[self.table.row(numeric_id)])))
+
+    def rebalance(self):
+        """Moves egos from the ranks with more than their share of the egos to the ranks with
+        fewer, if the most loaded rank has more than rebalance.threshold above the mean.
+
+        The number of egos and the last step time of each rank are gathered on every rank, so
+        all the ranks plan the same moves (see plan_rebalance). The moves are planned from the
+        numbers of egos only, so that a run stays reproducible. The moved egos are recorded in 
+        the ownership directory of every rank and are moved in batches of at most 
+        rebalance.batch.size egos per rank, with repast4py's move_agents through Ego.save and
+        restore_agent. Each rebalance is reported at the 'info' level and kept in rebalances.
+        """
+        _start = time.perf_counter()
+        counts = np.array(self.comm.allgather(self.table.n_active), dtype=np.int64)
+        step_times = self.comm.allgather(self.step_time)
+        imbalance = counts.max() / max(counts.mean(), 1) - 1
+        if imbalance <= self.rebalance_threshold:
+            return
+        moves = plan_rebalance(counts)
+
+        # the egos of the last rows of each source rank go to its destinations in order
+        t = self.table
+        _sent = sum(n for source, _, n in moves if source == self.rank)
+        _ids = t.numeric_id[t.active_rows()[t.n_active - _sent:]]
+        _destinations = np.repeat([destination for source, destination, _ in moves if source == self.rank],
+                                  [n for source, _, n in moves if source == self.rank]).astype(np.int32)
+        for ids, destinations in self.comm.allgather((_ids, _destinations)):
+            if len(ids) > 0 and ids.max() >= len(self.directory):
+                self.directory = np.concatenate([self.directory, np.full(ids.max() + 1 - len(self.directory), -1, dtype=np.int32)])
+            self.directory[ids] = destinations
+
+        # every rank takes part in each batch, also when it has nothing (left) to move
+        _largest = max(sum(n for source, _, n in moves if source == rank) for rank in range(self.size))
+        batches = -(-_largest // self.rebalance_batch_size)
+        for batch in range(batches):
+            ids = _ids[batch * self.rebalance_batch_size:(batch + 1) * self.rebalance_batch_size]
+            destinations = _destinations[batch * self.rebalance_batch_size:(batch + 1) * self.rebalance_batch_size]
+            uidranks = t.uid_rank[t.rows(ids)]
+            self.context.move_agents([((numericid, Ego.TYPE, uidrank), destination) for numericid, uidrank, destination
+                                      in zip(ids.tolist(), uidranks.tolist(), destinations.tolist())], restore_agent)
+            t.remove(ids)
+        t.compact()
+
+        rebalance = {'tick': self.runner.schedule.tick, 'imbalance': float(imbalance), 'moved': int(sum(n for _, _, n in moves)), 
+                     'batches': int(batches), 'seconds': time.perf_counter() - _start, 'egos': counts.tolist(), 'step_times': step_times}
+        self.rebalances.append(rebalance)
+        self.events.message('info', f"Rebalanced {rebalance['moved']} egos in {rebalance['batches']} batches in {rebalance['seconds']:.3f}s at tick {rebalance['tick']}: "
+                                    f"egos per rank {rebalance['egos']} ({imbalance:.1%} above the mean) with step times {['%.3f' % step_time for step_time in step_times]}")
 
     def step(self):
+        _start = time.perf_counter()
         tick = self.runner.schedule.tick
-        print(f'\nAgents are attending venues and using apps for week {tick} in simulation...\n')
+        self.events.message('info', f'\nAgents are attending venues and using apps for week {tick} in simulation...\n')
         # self.context.synchronize(restore_agent)
 
-        for sego in self.context.agents(Ego.TYPE):
-            ################
-            # attend venues 
-            ################
-            _sego_venues_dict = self.empop_venue_attendance_dict[sego.eego]
-            
-            _venues_attended = []
-            for thisvenue, thisattendancefreq in _sego_venues_dict.items():
-                for day in range(1,8):
-                    if random.default_rng.random() <= thisattendancefreq:
-                        _venues_attended.append(thisvenue)
-            
-            if not _venues_attended:
-                sego.venues_attended = sego.egoid
-            else:
-                assert(len(_venues_attended) >= 1)
-                sego.venues_attended = '|'.join(clean_venue_list(_venues_attended))
-            
-            ###########
-            # use apps
-            ###########
-            if sego.eego in self.empop_appuse_dict.keys():
-                sego.apps_used = self.empop_appuse_dict[sego.eego]
-            else:
-                sego.apps_used = sego.egoid
+        if self.size > 1 and self.rebalance_interval > 0 and tick % self.rebalance_interval == 0:
+            self.rebalance()
+        self.table.compact()
+        rows = self.table.active_rows()
+        ################
+        # attend venues 
+        ################
+        self.attend_venues(rows)
+
+        ###########
+        # use apps
+        ###########
+        self.use_apps(rows)
 
         self.log_agents()
+        self.step_time = time.perf_counter() - _start
 
 
+    def attend_venues(self, rows):
+        """Draws a week of venue attendance for the egos in the given rows of
+        the agent table using the model's attendance mode, for each replicate."""
+        if self.attendance_mode == 'scalar':
+            if self.random_streams == 'counter':
+                _stream = self.rng(0, 'attendance')
+                _venues_attended = [self.attend_venues_counter(thiseego, numericid, _stream)
+                                    for thiseego, numericid in zip(self.table.eego[rows].tolist(), self.table.numeric_id[rows].tolist())]
+            else:
+                _venues_attended = [self.attend_venues_scalar(thiseego) for thiseego in self.table.eego[rows].tolist()]
+            _offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+            np.cumsum([len(thesevenues) for thesevenues in _venues_attended], out=_offsets[1:])
+            _venues = np.concatenate(_venues_attended) if _venues_attended else []
+            self.table.set_codes('venues', rows, _offsets, _venues)
+            return
+        for replicate in range(self.replicates):
+            _offsets, _venues = draw_weekly_attendance(getattr(self.table, replicate_name('eego', replicate))[rows], self.eego_venue_matrix.indptr,
+                                                       self.eego_venue_matrix.indices, self.eego_weekly_probs, self.rng(replicate, 'attendance'),
+                                                       self.table.numeric_id[rows])
+            # the matrix columns are sorted within each row, so each ego's venues are already sorted and unique
+            self.table.set_codes(replicate_name('venues', replicate), rows, _offsets, _venues)
+
+    def attend_venues_scalar(self, eego):
+        """Reference attendance: one draw per venue per day of the week for a 
+        single ego with the given empirical ego, returning the codes of the venues attended."""
+        _matrix = self.eego_venue_matrix
+        _venues_attended = []
+        for entry in range(_matrix.indptr[eego], _matrix.indptr[eego + 1]):
+            for day in range(1,8):
+                if random.default_rng.random() <= _matrix.data[entry]:
+                    _venues_attended.append(_matrix.indices[entry])
+        return np.unique(np.array(_venues_attended, dtype=np.int32))
+
+    def attend_venues_counter(self, eego, numericid, stream):
+        """Reference attendance with counter streams: one draw per venue for the week for a single 
+        ego, from the same keys as the vectorized draw, returning the codes of the venues attended."""
+        _matrix = self.eego_venue_matrix
+        _venues_attended = []
+        for entry in range(_matrix.indptr[eego], _matrix.indptr[eego + 1]):
+            if stream.uniforms(numericid, _matrix.indices[entry]) < self.eego_weekly_probs[entry]:
+                _venues_attended.append(_matrix.indices[entry])
+        return np.array(_venues_attended, dtype=np.int32)
+
+    def use_apps(self, rows):
+        """Assigns the egos in the given rows of the agent table the apps of their empirical egos, for each replicate."""
+        for replicate in range(self.replicates):
+            _offsets, _apps = gather_rows(self.eego_app_indptr, self.eego_app_codes, getattr(self.table, replicate_name('eego', replicate))[rows])
+            self.table.set_codes(replicate_name('apps', replicate), rows, _offsets, _apps)
+
     def log_agents(self):
         tick = self.runner.schedule.tick
         if tick >= params['burnin.time.weeks']: 
-            for sego in self.context.agents():
-                self.agent_logger.log_row(tick, sego.id, sego.uid_rank, sego.egoid, sego.age, sego.agegroup, sego.raceethnicity, sego.hivstatus, sego.relationshipstatus, sego.eego, sego.venues_attended, sego.apps_used)
-        self.agent_logger.write()
+            t = self.table
+            rows = t.active_rows()
+            if self.counts_data_set is not None:
+                self.count_agents(rows)
+                self.counts_data_set.log(tick)
+            if self.agent_log_format in ('columnar', 'delta'):
+                self.agent_logger.log_tick(tick, self.agent_log_columns(rows))
+            elif self.agent_log_format == 'text':
+                for row, numericid, uidrank, egoid, age, agegroup, raceethnicity, hivstatus, relationshipstatus, eego in zip(
+                        rows.tolist(), t.numeric_id[rows].tolist(), t.uid_rank[rows].tolist(), t.egoid[rows], t.age[rows], t.agegroup[rows].tolist(), t.raceethnicity[rows].tolist(),
+                        t.hivstatus[rows].tolist(), t.relationshipstatus[rows].tolist(), self.eego_labels[t.eego[rows]]):
+                    self.agent_logger.log_row(tick, numericid, uidrank, egoid, age, AGE_GROUPS[agegroup], RACE_ETHNICITIES[raceethnicity], hivstatus, relationshipstatus,
+                                              eego, join_labels(self.venue_labels, t.codes('venues', row), egoid), join_labels(self.app_labels, t.codes('apps', row), egoid))
+        if self.agent_logger is not None:
+            self.agent_logger.write()
+
+    def count_agents(self, rows):
+        """Updates the counts of the egos in the given rows of the agent table with vectorized reductions."""
+        t = self.table
+        democodes = np.bincount(t.democode[rows], minlength=len(DEMOCODE_COUNTS) + 1)
+        self.counts.egos = len(rows)
+        for democode, name in enumerate(DEMOCODE_COUNTS, start=1):
+            setattr(self.counts, name, int(democodes[democode]))
+        self.counts.venues_attended = int(t.venues_count[rows].sum())
+        self.counts.venue_attenders = int(np.count_nonzero(t.venues_count[rows]))
+        self.counts.app_users = int(np.count_nonzero(t.apps_count[rows]))
+        for name, code_set, is_dating in (('dating_venue_attenders', 'venues', self.venue_is_dating), ('dating_app_users', 'apps', self.app_is_dating)):
+            (offsets, _), _ = split_code_sets(*t.gather_codes(code_set, rows), is_dating)
+            setattr(self.counts, name, int(np.count_nonzero(np.diff(offsets))))
+        self.counts.hiv_positive = int(np.count_nonzero(t.hivstatus[rows]))
+        self.counts.in_relationship = int(np.count_nonzero(t.relationshipstatus[rows]))
+
+    def agent_log_columns(self, rows) -> Dict:
+        """Returns the agent log columns (without the tick) of the given rows for the columnar log."""
+        t = self.table
+        columns = {'agent_id': t.numeric_id[rows].astype(np.int32),
+                   'agent_uid_rank': t.uid_rank[rows],
+                   'ego_id': t.egoid[rows],
+                   'age': t.age[rows],
+                   'age_group': t.agegroup[rows],
+                   'race_ethnicity': t.raceethnicity[rows],
+                   'hiv_status': t.hivstatus[rows],
+                   'relationship_status': t.relationshipstatus[rows],
+                   'assigned_eego': t.eego[rows]}
+        for column, name, labels in (('venues_attended', 'venues', self.venue_labels), ('apps_used', 'apps', self.app_labels)):
+            offsets, codes = t.gather_codes(name, rows)
+            columns[column + '_count'] = np.diff(offsets).astype(np.int32)
+            columns[column + '_codes'] = codes.astype(np.int16 if len(labels) <= np.iinfo(np.int16).max else np.int32)
+        return columns
 
     def remove_agent(self, agent):
-        print(f'{agent.egoid} is aged {agent.age}, {agent.raceethnicity} and is leaving the simulation.')
+        # the departure is recorded by the caller, see update_egos_from_epimodel
         self.context.remove(agent)
+        self.table.remove(agent.id)
 
     def add_agent_from_epimodel(self, agentid, agentegoid, agentraceethnicity, agentdemocode):
+        # the new ego is only added by the rank that owns it
+        if self.owner(agentid) != self.rank:
+            return
         sego = Ego(agentid, self.rank)
         sego.egoid = agentegoid
         sego.age = 16.0
@@ -267,164 +2067,359 @@ class Model:
         ######################
         # assign empirical ego
         ######################
-        sego.eego = random.default_rng.choice(self.empop_demo_buckets[str(sego.democode)])
+        sego.eego = self.draw_eego(agentid, int(sego.democode))
         #
         #########################################
         # have new ego attend venues and use apps
         #########################################
+        _row = np.array([self.table.row(sego.id)])
         # venues
-        _sego_venues_dict = self.empop_venue_attendance_dict[sego.eego]
-        _venues_attended = []
-        for thisvenue, thisattendancefreq in _sego_venues_dict.items():
-            for day in range(1,8):
-                if random.default_rng.random() <= thisattendancefreq:
-                    _venues_attended.append(thisvenue)
-        if not _venues_attended:
-            sego.venues_attended = sego.egoid
-        else:
-            assert(len(_venues_attended) >= 1)
-            sego.venues_attended = '|'.join(clean_venue_list(_venues_attended))                    
+        self.attend_venues(_row)
         # apps
-        if sego.eego in self.empop_appuse_dict.keys():
-            sego.apps_used = self.empop_appuse_dict[sego.eego]
-        else:
-            sego.apps_used = sego.egoid
+        self.use_apps(_row)
         #    
         ##########
         # add ego
         ##########
-        print(f'{sego.egoid} is age {sego.age} and {sego.raceethnicity} and is entering the model')    
+        self.events.record('entered', self.runner.schedule.tick, [sego.id], sego.democode,
+                           lambda: [f'{sego.egoid} is age {sego.age} and {sego.raceethnicity} and is entering the model'])
         self.context.add(sego)
 
+    def add_agents_from_epimodel(self, agentids, agentegoids, agentraceethnicities):
+        """Adds a batch of new 16 year old egos entering the Epimodel simulation.
+
+        The egos are appended to the agent table together, their empirical egos are
+        drawn from their demographic buckets in a single draw, and their first week of
+        venue attendance and appuse is assigned for the whole batch. Each rank only adds
+        the new egos it owns.
+
+        Args:
+            agentids: the numeric ids of the new egos
+            agentegoids: their egoids
+            agentraceethnicities: their RACE_ETHNICITIES index
+        """
+        _owned = self.owned(agentids)
+        agentids = np.asarray(agentids, dtype=np.int64)[_owned]
+        agentegoids = np.asarray(agentegoids, dtype=object)[_owned]
+        agentraceethnicities = np.asarray(agentraceethnicities, dtype=np.int8)[_owned]
+        _democodes = DEMOCODES_16TO20[agentraceethnicities]
+        rows = self.table.extend(agentids, self.rank,
+                                 egoid=np.asarray(agentegoids, dtype=object),
+                                 raceethnicity=agentraceethnicities,
+                                 democode=_democodes,
+                                 **{replicate_name('eego', replicate): draw_bucket_members(self.demo_bucket_indptr, self.demo_bucket_eegos, _democodes, 
+                                                                                      self.rng(replicate, 'eego'), agentids)
+                                    for replicate in range(self.replicates)})
+        self.attend_venues(rows)
+        self.use_apps(rows)
+        t = self.table
+        self.events.record('entered', self.runner.schedule.tick, t.numeric_id[rows], t.democode[rows],
+                           lambda: [f'{egoid} is age {age} and {RACE_ETHNICITIES[raceethnicity]} and is entering the model'
+                                    for egoid, age, raceethnicity in zip(t.egoid[rows], t.age[rows], t.raceethnicity[rows].tolist())])
+        for numericid in t.numeric_id[rows].tolist():
+            self.context.add(Ego(numericid, self.rank))
+
     def update_agent_agegroup_from_epimodel(self, egonumericid):
-        thissego = self.context.agent((egonumericid, 0, 0))
+        if self.owner(egonumericid) != self.rank:
+            return
+        thissego = self.agent(egonumericid)
         thissego.agegroup = '21to29'
         # update ego demogroup
-        if thissego.raceethnicity == 'whiteNH':
-            thissego.democode = 2
-        elif thissego.raceethnicity == 'blackNH':
-            thissego.democode = 4
-        elif thissego.raceethnicity == 'hispanic':
-            thissego.democode = 6
-        else:
-            assert (thissego.raceethnicity == 'otherNH')
-            thissego.democode = 8        
+        thissego.democode = int(DEMOCODES_21TO29[RACE_ETHNICITIES.index(thissego.raceethnicity)])
         # update empirical ego
-        thissego.eego = random.default_rng.choice(self.empop_demo_buckets[str(thissego.democode)])
-        print(f'{thissego.egoid} is {thissego.age} and has aged to age group {thissego.agegroup}.')
-
-
-    def update_egos_from_epimodel(self, activeegoslist, segos2egoiddict, segos2reldict, segos2hivdict, segos2agedict):
-        egos2remove = []
-        for sego in self.context.agents(Ego.TYPE):
-            segonumericid = int(sego.id)
-            if segonumericid in activeegoslist:
-                assert(sego.egoid == segos2egoiddict[segonumericid])
-                # update relationship status 
-                sego.relationshipstatus = segos2reldict[segonumericid]
-                # update hiv status
-                if (sego.hivstatus == 0):
-                    if segos2hivdict[segonumericid] == 1:
-                        sego.hivstatus = 1
-                        print(f'{sego.egoid} is {sego.raceethnicity}, aged {sego.age} in age group {sego.agegroup}, with relationship status of {sego.relationshipstatus} and is now HIV+.')
-                else:
-                    assert(sego.hivstatus == 1)
-                    if segos2hivdict[segonumericid] == 0:
-                        print(f"There is an error with the HIV status assignment for {sego.egoid} as an ego is switching from HIV+ to HIV-.")        
-                # update age
-                sego.age = segos2agedict[segonumericid]
-            else:
-                egos2remove.append(sego)
-        print("\nAgents are being removed from the simulation...")
-        for sego in egos2remove:
-            model.remove_agent(sego)
-
-    def attend_venues_for_epimodel(self, activeegoslist):
-        egos2venues = []
-        egos2venues_dating = []
-        egos2venues_nondating = []
-        for thisegonumericid in activeegoslist:   
-            thissego = self.context.agent((int(thisegonumericid), 0, 0))
-            egos2venues.append(thissego.venues_attended)
-            if thissego.venues_attended == thissego.egoid:
-                egos2venues_dating.append(thissego.venues_attended)
-                egos2venues_nondating.append(thissego.venues_attended)
-            else:
-                _thisego2venues_list = thissego.venues_attended.split("|")
-                _thisego2venues_list = clean_venue_list(_thisego2venues_list)
-                _thisego2venues_list_dating = []
-                _thisego2venues_list_nondating = []
-                for thisvenue in _thisego2venues_list:
-                    assert(len(thisvenue) > 1)
-                    if thisvenue in self.venues_dating:
-                        _thisego2venues_list_dating.append(thisvenue)
-                    else:
-                        assert(thisvenue in self.venues_nondating)
-                        _thisego2venues_list_nondating.append(thisvenue)                    
-                if len(_thisego2venues_list_dating) > 0:
-                    _thisego2venues_list_dating = clean_venue_list(_thisego2venues_list_dating)
-                else:
-                    assert(len(_thisego2venues_list_dating) == 0)
-                    _thisego2venues_list_dating.append(thissego.egoid)
-                if len(_thisego2venues_list_nondating) > 0:
-                    _thisego2venues_list_nondating = clean_venue_list(_thisego2venues_list_nondating)
-                else:
-                    assert(len(_thisego2venues_list_nondating) == 0)
-                    _thisego2venues_list_nondating.append(thissego.egoid)                
-                egos2venues_dating.append('|'.join(_thisego2venues_list_dating))
-                egos2venues_nondating.append('|'.join(_thisego2venues_list_nondating))
-        #
+        thissego.eego = self.draw_eego(egonumericid, thissego.democode)
+        self.events.record('aged', self.runner.schedule.tick, [egonumericid], AGE_GROUPS.index(thissego.agegroup),
+                           lambda: [f'{thissego.egoid} is {thissego.age} and has aged to age group {thissego.agegroup}.'])
+
+    def update_agents_agegroup_from_epimodel(self, egonumericids):
+        """Moves a batch of egos that have turned 21 in the Epimodel simulation into the
+        21to29 age group, looking up their new democodes from their race/ethnicity and
+        drawing their new empirical egos from the demographic buckets in a single draw.
+        Each rank only updates the egos it owns."""
+        t = self.table
+        egonumericids = np.asarray(egonumericids, dtype=np.int64)
+        rows = t.rows(egonumericids[self.owned(egonumericids)])
+        assert((rows >= 0).all())
+        t.agegroup[rows] = AGE_GROUPS.index('21to29')
+        t.democode[rows] = DEMOCODES_21TO29[t.raceethnicity[rows]]
+        for replicate in range(self.replicates):
+            getattr(t, replicate_name('eego', replicate))[rows] = draw_bucket_members(self.demo_bucket_indptr, self.demo_bucket_eegos, t.democode[rows], 
+                                                                                          self.rng(replicate, 'eego'), t.numeric_id[rows])
+        self.events.record('aged', self.runner.schedule.tick, t.numeric_id[rows], t.agegroup[rows],
+                           lambda: [f'{t.egoid[row]} is {t.age[row]} and has aged to age group {AGE_GROUPS[t.agegroup[row]]}.' for row in rows.tolist()])
+
+
+    def update_egos_from_epimodel(self, activeegoids, activeegoegoids, activeegorelstatus, activeegohivstatus, activeegoages):
+        """Reconciles the egos with the active egos of the Epimodel simulation, given as 
+        aligned arrays of their numeric ids, egoids, relationship status, hiv status and ages.
+        Egos that are no longer active are removed from the simulation. Each rank only 
+        updates and removes the egos it owns."""
+        t = self.table
+        activeegoids = np.asarray(activeegoids, dtype=np.int64)
+        _owned = self.owned(activeegoids)
+        rows = t.rows(activeegoids[_owned])
+        known = _owned[rows >= 0]
+        rows = rows[rows >= 0]
+        assert((t.egoid[rows] == np.asarray(activeegoegoids, dtype=object)[known]).all())
+        # update relationship status 
+        t.relationshipstatus[rows] = np.asarray(activeegorelstatus)[known]
+        # update hiv status
+        _hivstatus = np.asarray(activeegohivstatus)[known]
+        _newlyhivpos = rows[(t.hivstatus[rows] == 0) & (_hivstatus == 1)]
+        _hivposerrors = rows[(t.hivstatus[rows] == 1) & (_hivstatus == 0)]
+        t.hivstatus[_newlyhivpos] = 1
+        tick = self.runner.schedule.tick
+        self.events.record('hiv_positive', tick, t.numeric_id[_newlyhivpos],
+                           describe=lambda: [f'{t.egoid[row]} is {RACE_ETHNICITIES[t.raceethnicity[row]]}, aged {t.age[row]} in age group {AGE_GROUPS[t.agegroup[row]]}, with relationship status of {t.relationshipstatus[row]} and is now HIV+.'
+                                             for row in _newlyhivpos.tolist()])
+        self.events.record('hiv_status_error', tick, t.numeric_id[_hivposerrors],
+                           describe=lambda: [f"There is an error with the HIV status assignment for {t.egoid[row]} as an ego is switching from HIV+ to HIV-." 
+                                             for row in _hivposerrors.tolist()])
+        # update age
+        t.age[rows] = np.asarray(activeegoages)[known]
+        # the egos that are no longer active
+        _activerows = t.active_rows()
+        _departedrows = _activerows[~np.isin(t.numeric_id[_activerows], activeegoids)]
+        self.events.message('info', "\nAgents are being removed from the simulation...")
+        self.events.record('left', tick, t.numeric_id[_departedrows],
+                           describe=lambda: [f'{t.egoid[row]} is aged {t.age[row]}, {RACE_ETHNICITIES[t.raceethnicity[row]]} and is leaving the simulation.'
+                                             for row in _departedrows.tolist()])
+        for numericid in t.numeric_id[_departedrows].tolist():
+            self.remove_agent(self.agent(numericid))
+
+    def export_code_sets(self, name, activeegoslist, is_dating, egoids=False, replicate=0):
+        """Gathers the given code sets (venues or apps) of the active egos in the given 
+        replicate and splits them into dating and nondating sets in one pass over the whole population.
+        When the egos are distributed, each rank gathers the code sets of the active 
+        egos it owns and every rank returns those of all the active egos (see allgather_code_sets).
+
+        Returns:
+            A tuple of the egoids of the active egos (or None if egoids is False) and the 
+            (offsets, codes) CSR layouts of all, dating and nondating code sets.
+        """
+        activeegoslist = np.asarray(activeegoslist, dtype=np.int64)
+        name = replicate_name(name, replicate)
+        if self.size == 1:
+            rows = self.table.rows(activeegoslist)
+            assert((rows >= 0).all())
+            _egoids = self.table.egoid[rows] if egoids else None
+            _all = self.table.gather_codes(name, rows)
+        else:
+            _owned = activeegoslist[self.owned(activeegoslist)]
+            rows = self.table.rows(_owned)
+            assert((rows >= 0).all())
+            _egoids, _all = allgather_code_sets(self.comm, activeegoslist, _owned, self.table.egoid[rows] if egoids else None,
+                                                *self.table.gather_codes(name, rows))
+        # codes are sorted, so the dating and nondating sets stay in natural order
+        _dating, _nondating = split_code_sets(*_all, is_dating)
+        return _egoids, _all, _dating, _nondating
+
+    def attend_venues_for_epimodel(self, activeegoslist, replicate=0):
+        _egoids, _all, _dating, _nondating = self.export_code_sets('venues', activeegoslist, self.venue_is_dating, egoids=True, replicate=replicate)
         egos2venues_df = pd.DataFrame({'numeric_id' : activeegoslist,
-                            'venues_all' : egos2venues,
-                            'venues_dating' : egos2venues_dating,
-                            'venues_nondating' : egos2venues_nondating,
+                            'venues_all' : join_label_rows(self.venue_labels, *_all, _egoids),
+                            'venues_dating' : join_label_rows(self.venue_labels, *_dating, _egoids),
+                            'venues_nondating' : join_label_rows(self.venue_labels, *_nondating, _egoids),
                         })
         return egos2venues_df
     
-    def use_apps_for_epimodel(self, activeegoslist):
-        egos2apps = []
-        egos2apps_dating = []
-        egos2apps_nondating = []
-        for thisegonumericid in activeegoslist:
-            thissego = self.context.agent((int(thisegonumericid), 0, 0))
-            egos2apps.append(thissego.apps_used)
-            if (thissego.apps_used == thissego.egoid):
-                egos2apps_dating.append(thissego.apps_used)
-                egos2apps_nondating.append(thissego.apps_used)
-            else:
-                _thisego2apps_list = thissego.apps_used.split("|")
-                _thisego2apps_list = clean_venue_list(_thisego2apps_list)
-                _thisego2apps_list_dating = []
-                _thisego2apps_list_nondating = []
-                for thisapp in _thisego2apps_list:
-                    if thisapp in self.apps_dating:
-                        _thisego2apps_list_dating.append(thisapp)
-                    else:
-                        assert(thisapp in self.apps_nondating)
-                        _thisego2apps_list_nondating.append(thisapp)
-                if len(_thisego2apps_list_dating) > 0:
-                    _thisego2apps_list_dating = clean_venue_list(_thisego2apps_list_dating)
-                else:  
-                    assert(len(_thisego2apps_list_dating) == 0)
-                    _thisego2apps_list_dating.append(thissego.egoid)   
-                if len(_thisego2apps_list_nondating) > 0:
-                    _thisego2apps_list_nondating = clean_venue_list(_thisego2apps_list_nondating)
-                else:
-                    assert(len(_thisego2apps_list_nondating) == 0)
-                    _thisego2apps_list_nondating.append(thissego.egoid) 
-                egos2apps_dating.append('|'.join(_thisego2apps_list_dating))
-                egos2apps_nondating.append('|'.join(_thisego2apps_list_nondating))
+    def use_apps_for_epimodel(self, activeegoslist, replicate=0):
+        _egoids, _all, _dating, _nondating = self.export_code_sets('apps', activeegoslist, self.app_is_dating, egoids=True, replicate=replicate)
         egos2apps_df = pd.DataFrame({
                             'numeric_id':activeegoslist,
-                            'apps_all':egos2apps,
-                            'apps_dating':egos2apps_dating,
-                            'apps_nondating':egos2apps_nondating,
+                            'apps_all':join_label_rows(self.app_labels, *_all, _egoids),
+                            'apps_dating':join_label_rows(self.app_labels, *_dating, _egoids),
+                            'apps_nondating':join_label_rows(self.app_labels, *_nondating, _egoids),
                         })
         return egos2apps_df
 
+    def export_code_arrays(self, name, activeegoslist, is_dating, replicate=0):
+        """Exports the code sets (venues or apps) of the active egos as integer arrays 
+        instead of pipe-joined strings, so they cross over to R as whole vectors.
+
+        Each of the all, dating and nondating categories is given in CSR layout: the 
+        codes of the i-th ego are <name>_<category>_codes[offsets[i]:offsets[i + 1]], 
+        with 0-based offsets and codes indexing the labels of venue_labels/app_labels. 
+        Egos without venues or apps simply have an empty range.
+
+        Returns:
+            A dict of int32 arrays, numeric_id and the offsets and codes of each category.
+        """
+        _, _all, _dating, _nondating = self.export_code_sets(name, activeegoslist, is_dating, replicate=replicate)
+        codes = {'numeric_id': np.asarray(activeegoslist).astype(np.int32)}
+        for category, (offsets, _codes) in (('all', _all), ('dating', _dating), ('nondating', _nondating)):
+            codes[f'{name}_{category}_offsets'] = np.ascontiguousarray(offsets, dtype=np.int32)
+            codes[f'{name}_{category}_codes'] = np.ascontiguousarray(_codes, dtype=np.int32)
+        return codes
+
+    def export_replicate_code_arrays(self, name, activeegoslist, is_dating):
+        """Exports the code sets of the active egos in every replicate like export_code_arrays,
+        as the rows of replicate 0 followed by those of each further replicate, tagged by the 
+        int32 replicate and numeric_id of each row."""
+        parts = [self.export_code_arrays(name, activeegoslist, is_dating, replicate) for replicate in range(self.replicates)]
+        codes = {'replicate': np.repeat(np.arange(self.replicates, dtype=np.int32), len(activeegoslist)),
+                 'numeric_id': np.concatenate([part['numeric_id'] for part in parts])}
+        for category in ('all', 'dating', 'nondating'):
+            # the offsets of each replicate continue from the codes of the replicates before it
+            _shifts = np.cumsum([0] + [len(part[f'{name}_{category}_codes']) for part in parts[:-1]])
+            codes[f'{name}_{category}_offsets'] = np.concatenate([parts[0][f'{name}_{category}_offsets'][:1]] +
+                                                                 [part[f'{name}_{category}_offsets'][1:] + shift for part, shift in zip(parts, _shifts.tolist())]).astype(np.int32)
+            codes[f'{name}_{category}_codes'] = np.concatenate([part[f'{name}_{category}_codes'] for part in parts])
+        return codes
+
+    def colocate_for_epimodel(self, activeegoslist, pairs=True, replicate=0):
+        """Finds the pairs of active egos that attended at least one common venue this 
+        week in the given replicate, for all, dating and nondating venues, leaving out the
+        venues with more attendees than colocation.venue.cap.
+
+        Returns:
+            A dict with, for each category, either the int32 numeric ids of the two egos 
+            of each pair (venues_<category>_ego1 and _ego2) and the number of venues 
+            they share (venues_<category>_shared), or only the number of pairs 
+            (venues_<category>_pairs) when pairs is False, and the capped venue codes.
+        """
+        _, _all, _dating, _nondating = self.export_code_sets('venues', activeegoslist, self.venue_is_dating, replicate=replicate)
+        _numericids = np.asarray(activeegoslist).astype(np.int32)
+        colocation = {}
+        capped = []
+        for category, (offsets, codes) in (('all', _all), ('dating', _dating), ('nondating', _nondating)):
+            _ego1, _ego2, _shared, _capped = colocated_pairs(offsets, codes, len(self.venue_labels), self.colocation_venue_cap)
+            if pairs:
+                colocation[f'venues_{category}_ego1'] = _numericids[_ego1]
+                colocation[f'venues_{category}_ego2'] = _numericids[_ego2]
+                colocation[f'venues_{category}_shared'] = _shared
+            else:
+                colocation[f'venues_{category}_pairs'] = len(_shared)
+            capped.append(_capped)
+        colocation['venues_capped'] = np.unique(np.concatenate(capped)).astype(np.int32)
+        # every rank colocates the gathered venues of all the active egos, the capped venues are recorded by rank 0
+        if self.rank == 0:
+            self.events.record('venue_capped', self.runner.schedule.tick, np.full(len(colocation['venues_capped']), -1), colocation['venues_capped'],
+                               lambda: [f"{len(colocation['venues_capped'])} venues with more than {self.colocation_venue_cap} attendees were left out of the colocation: {'|'.join(self.venue_labels[colocation['venues_capped']])}"])
+        return colocation
+
+    def checkpoint_path(self, path: str) -> str:
+        # each rank has its own checkpoint file when the model is distributed
+        return path if self.comm.Get_size() == 1 else f'{path}.{self.rank}'
+
+    def checkpoint(self, path: str):
+        """Saves the state of the model to a compressed npz file: the agent table with the venues
+        and apps of each ego (in each replicate), the uids in the agent_cache, the ownership directory, 
+        the tick, the egoid counter, the state of repast4py's default_rng and of the replicates'
+        streams and the seed of the counter streams, so that a restored model continues with the same draws."""
+        t = self.table
+        t.compact()
+        rows = t.active_rows()
+        saved = {name: getattr(t, name)[rows] for name in ('numeric_id', 'uid_rank', 'egoid', 'age', 'agegroup', 'raceethnicity', 'democode',
+                                                           'hivstatus', 'relationshipstatus') + tuple(replicate_name('eego', replicate) for replicate in range(t.replicates))}
+        saved['egoid'] = saved['egoid'].astype(str)
+        for name in t.code_sets:
+            saved[name + '_offsets'], saved[name + '_codes'] = t.gather_codes(name, rows)
+        saved['cache_uids'] = np.array(list(agent_cache), dtype=np.int64).reshape(-1, 3)
+        saved['directory'] = self.directory
+        state = {'tick': self.runner.schedule.tick, 'egoidcounter': self.egoidcounter,
+                 'rng_state': random.default_rng.bit_generator.state,
+                 'replicate_rng_states': [rng.bit_generator.state for rng in self.replicate_rngs],
+                 'stream_seed': stream_seed}
+        saved['state'] = np.frombuffer(json.dumps(state).encode(), dtype=np.uint8)
+        path = self.checkpoint_path(path)
+        # written to a temporary file first, so a run killed while saving keeps its previous checkpoint
+        temporary = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez_compressed(temporary, **saved)
+        os.replace(temporary, path)
+
+    def restore(self, path: str):
+        """Replaces the state of the model with the one saved by checkpoint, rescheduling the
+        step to continue from the tick after the saved tick. The logs are left as opened with the
+        model, so the restored segment of a run writes its agent log and event file to the next
+        free file names (e.g. agent_log_1.col) next to those of the earlier segments."""
+        with np.load(self.checkpoint_path(path)) as saved:
+            saved = {name: saved[name] for name in saved.files}
+        state = json.loads(saved['state'].tobytes())
+
+        for sego in list(self.context.agents()):
+            self.context.remove(sego)
+        agent_cache.clear()
+        t = self.table
+        t.clear()
+        rows = t.extend(saved['numeric_id'], saved['uid_rank'],
+                        egoid=saved['egoid'].astype(object),
+                        **{name: saved[name] for name in ('age', 'agegroup', 'raceethnicity', 'democode', 'hivstatus', 'relationshipstatus') + 
+                           tuple(replicate_name('eego', replicate) for replicate in range(t.replicates))})
+        for name in t.code_sets:
+            t.set_codes(name, rows, saved[name + '_offsets'], saved[name + '_codes'])
+        for numericid, uidrank in zip(saved['numeric_id'].tolist(), saved['uid_rank'].tolist()):
+            self.context.add(Ego(numericid, uidrank))
+        # the cached agents that are no longer in the model only keep their view
+        _uncached = []
+        for uid in saved['cache_uids'].tolist():
+            if not t.contains(uid[0]):
+                _uncached.append(uid[0])
+            agent_cache[tuple(uid)] = Ego(uid[0], uid[2])
+        t.remove(_uncached)
+        t.compact()
+
+        self.egoidcounter = state['egoidcounter']
+        self.directory = saved['directory'] if 'directory' in saved else np.full(0, -1, dtype=np.int32)
+        random.default_rng.bit_generator.state = state['rng_state']
+        for rng, rng_state in zip(self.replicate_rngs, state.get('replicate_rng_states', [])):
+            rng.bit_generator.state = rng_state
+        global stream_seed
+        stream_seed = state.get('stream_seed', stream_seed)
+        self.runner = schedule.init_schedule_runner(self.comm)
+        self.runner.schedule_repeating_event(state['tick'] + 1, 1, self.step)
+        self.runner.schedule.tick = state['tick']
+
+    def open_logs(self, agent_log_file: str, counts_log_file: str = '', events_file: str = ''):
+        """Opens the agent log in the model's log format, the event stream and, if files are given,
+        the aggregate log of the counts of each tick and the event file."""
+        params = self.params
+        self.logs_closed = False
+        # the events are counted, recorded to the event file of each rank and only printed at the print level
+        if events_file and self.comm.Get_size() > 1:
+            events_file = f'{events_file}.{self.rank}'
+        self.events = EventLog(events_file, params.get('events.record.level', 'debug'), params.get('events.print.level', 'warning'),
+                               int(params.get('events.buffer.size', 65536)))
+        _log_labels = {'age_group': AGE_GROUPS, 'race_ethnicity': RACE_ETHNICITIES, 'assigned_eego': self.eego_labels,
+                       'venues_attended': self.venue_labels, 'apps_used': self.app_labels}
+        # the writes can be run by a background writer thread, off the step
+        self.log_writer = AsyncLogWriter(int(params.get('agent.log.queue.size', 8))) if params.get('agent.log.async', False) else None
+        if self.agent_log_format == 'columnar':
+            self.agent_logger = ColumnarAgentLogger(self.comm, agent_log_file, _log_labels, int(params.get('agent.log.group.ticks', 52)), self.log_writer)
+        elif self.agent_log_format == 'delta':
+            self.agent_logger = DeltaAgentLogger(self.comm, agent_log_file, _log_labels, int(params.get('agent.log.group.ticks', 52)),
+                                                 int(params.get('agent.log.keyframe.ticks', 52)), self.log_writer)
+        elif self.agent_log_format == 'none':
+            self.agent_logger = None
+        elif self.log_writer is not None:
+            self.agent_logger = AsyncTabularLogger(self.comm, agent_log_file, list(AGENT_LOG_COLUMNS), self.log_writer)
+        else:
+            self.agent_logger = logging.TabularLogger(self.comm, agent_log_file, list(AGENT_LOG_COLUMNS))
+
+        # initialize aggregate logging of the counts of each tick, summed over the ranks
+        self.counts_data_set = None
+        if counts_log_file:
+            loggers = logging.create_loggers(self.counts, op=MPI.SUM, rank=self.rank)
+            self.counts_data_set = logging.ReducingDataSet(loggers, self.comm, counts_log_file)
+
+    def close_logs(self):
+        # the logs are closed once, e.g. by end_chistig and again by exit_replicate
+        if self.logs_closed:
+            return
+        self.logs_closed = True
+        if self.agent_logger is not None:
+            self.agent_logger.close()
+        if self.counts_data_set is not None:
+            self.counts_data_set.close()
+        if self.log_writer is not None:
+            self.log_writer.close()
+            self.events.message('info', f'Agent log writer: {self.log_writer.stats()}')
+        self.events.close()
+        self.events.message('info', f'Events: {self.events.summary()}')
+
     def at_end(self):
-        self.agent_logger.close()
-        
+        self.close_logs()
+
     def run(self):
         pass
         # self.runner.execute()
@@ -439,13 +2434,36 @@ def run(params: Dict):
     model = Model(MPI.COMM_WORLD, params)
 
 
+# the seed the counter streams are keyed by, the same on every rank (see init_random)
+stream_seed = 0
+
+
+def init_random(seed, offset=0):
+    """Seeds repast4py's default_rng with the seed plus offset (e.g. the rank) and
+    keys the counter streams by the seed itself."""
+    global stream_seed
+    random.init(int(seed) + offset)
+    stream_seed = int(seed)
+
+
 def set_random_seed(random_seed_str):
-    random.init(int(random_seed_str))
+    # each rank draws its own stream, rank 0 (the only one of an undistributed run) the seed's
+    init_random(int(random_seed_str), MPI.COMM_WORLD.Get_rank())
+    if model is not None:
+        model.seed_replicates()
 
 
-def create_params(parameters_file):
+def create_params(parameters_file, compiled=True):
+    # the compiled params leave the empirical tables out of the params that go back to R (see compile_params)
     global params 
-    params = parameters.init_params(parameters_file, '')
+    if compiled:
+        # compile_params seeds through init_random
+        params = compile_params(parameters_file)
+    else:
+        # init_params seeds repast4py's default_rng from random.seed, which also keys the counter streams
+        params = parameters.init_params(parameters_file, '')
+        if 'random.seed' in params:
+            init_random(params['random.seed'])
     return params
 
 def hello_world():
@@ -458,31 +2476,30 @@ def read_data(passeddata):
     pass
 
 def update_age_groups(newly21nodesdf):
-    print("\nAgents who have aged to a new age group are being updated...")
+    model.events.message('info', "\nAgents who have aged to a new age group are being updated...")
     if len(newly21nodesdf) > 0:
-        for index, row in newly21nodesdf.iterrows():
-            model.update_agent_agegroup_from_epimodel(int(row['numeric.id']))
+        numericids = newly21nodesdf['numeric.id'].to_numpy().astype(np.int64)
+        if model.attendance_mode == 'scalar':
+            # the reference mode keeps the original order of draws, one agent at a time
+            for numericid in numericids.tolist():
+                model.update_agent_agegroup_from_epimodel(numericid)
+        else:
+            model.update_agents_agegroup_from_epimodel(numericids)
     else:
         pass
 
 def update_egos(segosdf):
-    print("")
-    print("The ages, hiv status, and relationship status for the agents are being updated...")
+    model.events.message('info', "\nThe ages, hiv status, and relationship status for the agents are being updated...")
     # this method will do the following:
     # - update the ages of all of the egos to match the Epimodel simulation
     # - update the HIV status of all the egos to match the Epimodel simulation
     # - update the relationship status of all the egos to match the Epimodel simulation
     # - remove all of the non-active egos from the colocation model (who are no longer in the Epimodel simulation)
-    segosdf['numeric.id'] = segosdf['numeric.id'].astype(int)
-    segosdf['hiv_status'] = segosdf['hiv_status'].astype(int)
-    segosdf['rel_status'] = segosdf['rel_status'].astype(int)
-
-    active_egos = segosdf['numeric.id'].to_list()
-    segos2egoid_dict = segosdf.set_index('numeric.id')['egoid'].to_dict()
-    segos2rel_dict = segosdf.set_index('numeric.id')['rel_status'].to_dict()
-    segos2hiv_dict = segosdf.set_index('numeric.id')['hiv_status'].to_dict()
-    segos2age_dict = segosdf.set_index('numeric.id')['age'].to_dict()
-    model.update_egos_from_epimodel(active_egos, segos2egoid_dict, segos2rel_dict, segos2hiv_dict, segos2age_dict)
+    model.update_egos_from_epimodel(segosdf['numeric.id'].to_numpy().astype(np.int64),
+                                    segosdf['egoid'].to_numpy(dtype=object),
+                                    segosdf['rel_status'].to_numpy().astype(np.int8),
+                                    segosdf['hiv_status'].to_numpy().astype(np.int8),
+                                    segosdf['age'].to_numpy().astype(np.float32))
 
 
 def obtain_venue_attendance(activesegosdf):
@@ -499,29 +2516,170 @@ def obtain_app_use(activesegosdf):
     return apps_df
 
 
+def obtain_venue_attendance_codes(activesegosdf):
+    # integer coded alternative to obtain_venue_attendance, see Model.export_code_arrays
+    active_egos = activesegosdf['numeric.id'].to_numpy().astype(np.int64)
+    return model.export_code_arrays('venues', active_egos, model.venue_is_dating)
+
+
+def obtain_app_use_codes(activesegosdf):
+    # integer coded alternative to obtain_app_use, see Model.export_code_arrays
+    active_egos = activesegosdf['numeric.id'].to_numpy().astype(np.int64)
+    return model.export_code_arrays('apps', active_egos, model.app_is_dating)
+
+
+def obtain_venue_colocation(activesegosdf, pairs=True):
+    # the colocated pairs of active egos (or only their number), see Model.colocate_for_epimodel
+    active_egos = activesegosdf['numeric.id'].to_numpy().astype(np.int64)
+    return model.colocate_for_epimodel(active_egos, pairs)
+
+
+def obtain_replicate_venue_attendance_codes(activesegosdf):
+    # the venue codes of the active egos in every replicate, tagged by replicate, see Model.export_replicate_code_arrays
+    active_egos = activesegosdf['numeric.id'].to_numpy().astype(np.int64)
+    return model.export_replicate_code_arrays('venues', active_egos, model.venue_is_dating)
+
+
+def obtain_replicate_app_use_codes(activesegosdf):
+    # the app codes of the active egos in every replicate, tagged by replicate, see Model.export_replicate_code_arrays
+    active_egos = activesegosdf['numeric.id'].to_numpy().astype(np.int64)
+    return model.export_replicate_code_arrays('apps', active_egos, model.app_is_dating)
+
+
+def obtain_replicate_venue_attendance(activesegosdf):
+    # the obtain_venue_attendance frames of every replicate, one after the other with a replicate column
+    active_egos = activesegosdf['numeric.id'].to_numpy().astype(int).tolist()
+    return pd.concat([model.attend_venues_for_epimodel(active_egos, replicate).assign(replicate=replicate) for replicate in range(model.replicates)],
+                     ignore_index=True)
+
+
+def obtain_replicate_app_use(activesegosdf):
+    # the obtain_app_use frames of every replicate, one after the other with a replicate column
+    active_egos = activesegosdf['numeric.id'].to_numpy().astype(int).tolist()
+    return pd.concat([model.use_apps_for_epimodel(active_egos, replicate).assign(replicate=replicate) for replicate in range(model.replicates)],
+                     ignore_index=True)
+
+
+def obtain_venue_labels():
+    # the venue of each venue code, code i is the (i+1)-th label on the R side
+    return model.venue_labels.tolist()
+
+
+def obtain_app_labels():
+    # the app of each app code, code i is the (i+1)-th label on the R side
+    return model.app_labels.tolist()
+
+
 def add_agents_to_simulation(newnodesdf):
-    print("\nNew agents are being added to the simulation...")
+    model.events.message('info', "\nNew agents are being added to the simulation...")
     if len(newnodesdf) > 0:
-        for index, row in newnodesdf.iterrows():
-            numericid = int(row['numeric.id'])
-            egoid = row['egoid']
-            if int(row['race_ethnicity']) == 1:
-                raceethnicity = 'blackNH'
-                democode = 3
-            elif int(row['race_ethnicity']) == 2:
-                raceethnicity = 'hispanic'
-                democode = 5
-            elif int(row['race_ethnicity']) == 3:
-                raceethnicity = 'otherNH'
-                democode = 7
-            else:
-                assert(int(row['race_ethnicity']) == 4)
-                raceethnicity = 'whiteNH'
-                democode = 1                 
-            model.add_agent_from_epimodel(numericid, egoid, raceethnicity, democode)
+        numericids = newnodesdf['numeric.id'].to_numpy().astype(np.int64)
+        egoids = newnodesdf['egoid'].to_numpy(dtype=object)
+        raceethnicities = newnodesdf['race_ethnicity'].to_numpy().astype(np.int64) - 1
+        assert(((raceethnicities >= 0) & (raceethnicities < len(RACE_ETHNICITIES))).all())
+        if model.attendance_mode == 'scalar':
+            # the reference mode keeps the original order of draws, one new agent at a time
+            for numericid, egoid, raceethnicity in zip(numericids.tolist(), egoids, raceethnicities.tolist()):
+                model.add_agent_from_epimodel(numericid, egoid, RACE_ETHNICITIES[raceethnicity], int(DEMOCODES_16TO20[raceethnicity]))
+        else:
+            model.add_agents_from_epimodel(numericids, egoids, raceethnicities)
     else:
         pass
 
 
 def end_chistig():
-    model.at_end()
\ No newline at end of file
+    model.at_end()
+
+
+def exit_replicate(status=0):
+    """Ends a replicate forked by fork_replicates. The driver calls it in the child once the 
+    replicate's R side output is saved (e.g. the saveRDS of its EpiModel sim), as it ends the 
+    embedding R process too. The model's logs are closed if end_chistig has not closed them, and
+    the child exits without the MPI finalize inherited from the forking process, which would hang.
+
+    Args:
+        status: the exit status of the child, nonzero for a failed replicate
+    """
+    assert(model.replicate is not None), 'exit_replicate ends the children of fork_replicates'
+    model.at_end()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(int(status))
+
+
+def fork_replicates(seeds, agent_log_files, counts_log_files=None, max_children=None, events_files=None):
+    """Forks the warm model (e.g. after the burn-in) into one child process per replicate, each
+    of which inherits the whole process, the model's memory included, copy-on-write.
+
+    The model's logs are closed before forking. Each child reseeds repast4py's default_rng with 
+    its replicate's seed, opens its own agent log (and counts log and event file) and returns, so the calling 
+    script continues the replicate in the child and ends it with exit_replicate once the replicate's
+    output is saved. Only the python side is reseeded: the driver must also reseed R's RNG in each
+    child (e.g. set.seed with the replicate's seed), or the R side of every replicate is the same.
+    At most max_children (by default the number of cpus) children run at once. Forking needs a 
+    single MPI rank.
+
+    Args:
+        seeds: the random seed of each replicate
+        agent_log_files: the agent log file of each replicate
+        counts_log_files: the counts log file of each replicate, if counts are logged
+        max_children: the number of replicates run at the same time
+        events_files: the event file of each replicate, if events are recorded
+
+    Returns:
+        In each child, the index of its replicate. In the forking process, -1 once all the children
+        have exited, after which the calling script should stop.
+    """
+    assert(model.comm.Get_size() == 1)
+    seeds = np.atleast_1d(seeds).astype(np.int64).tolist()
+    agent_log_files = np.atleast_1d(agent_log_files).tolist()
+    counts_log_files = [''] * len(seeds) if counts_log_files is None else np.atleast_1d(counts_log_files).tolist()
+    events_files = [''] * len(seeds) if events_files is None else np.atleast_1d(events_files).tolist()
+    max_children = os.cpu_count() if max_children is None else int(max_children)
+    model.close_logs()
+    sys.stdout.flush()
+    children = {}
+    failed = []
+    for replicate, seed in enumerate(seeds):
+        if len(children) >= max_children:
+            pid, status = os.wait()
+            if status != 0:
+                failed.append(children[pid])
+            del children[pid]
+        pid = os.fork()
+        if pid == 0:
+            model.replicate = replicate
+            init_random(seed)
+            model.seed_replicates()
+            model.open_logs(agent_log_files[replicate], counts_log_files[replicate], events_files[replicate])
+            return replicate
+        children[pid] = replicate
+    while children:
+        pid, status = os.wait()
+        if status != 0:
+            failed.append(children[pid])
+        del children[pid]
+    if failed:
+        model.events.message('warning', f'The replicates {sorted(failed)} exited with an error.')
+    return -1
+
+
+def checkpoint(path):
+    # saves the model to continue it later with restore, e.g. in the next job of a long run
+    model.checkpoint(path)
+
+
+def restore(path):
+    # continues a checkpointed model, after create_params and run have set up the model and opened
+    # its logs, which do not overwrite those of the checkpointed segment (see Model.restore)
+    model.restore(path)
+
+
+def rebalance_stats():
+    # the tick, imbalance, moved egos, batches, seconds, egos and step times of each rank of every rebalance so far
+    return model.rebalances
+
+
+def log_writer_stats():
+    # the queue depth and write latency counters of the background log writer, if any
+    return model.log_writer.stats() if model.log_writer is not None else {}
\ No newline at end of file
@@ -0,0 +1,143 @@
+"""Round trip of the binary agent logs: a few ticks of a churning population are logged as
+the text log and as the columnar and delta logs, and the columnar and delta logs read back
+must reproduce the text log. Run with python -m pytest test_agent_log_formats.py"""
+import os
+
+import numpy as np
+import pandas as pd
+from mpi4py import MPI
+from repast4py import logging
+
+import chistig_colocation_model_reticulate as chistig
+
+
+AGE_GROUPS = chistig.AGE_GROUPS
+RACE_ETHNICITIES = chistig.RACE_ETHNICITIES
+EEGO_LABELS = np.array([f'e{eego:03d}' for eego in range(40)], dtype=object)
+VENUE_LABELS = np.array([f'v{venue:02d}' for venue in range(25)], dtype=object)
+APP_LABELS = np.array([f'a{app}' for app in range(6)], dtype=object)
+LABELS = {'age_group': AGE_GROUPS, 'race_ethnicity': RACE_ETHNICITIES, 'assigned_eego': EEGO_LABELS,
+          'venues_attended': VENUE_LABELS, 'apps_used': APP_LABELS}
+
+
+def draw_code_sets(rng, n, n_codes, max_codes):
+    # sorted, unique code sets of up to max_codes codes per agent, as counts and flat codes
+    sets = [np.sort(rng.choice(n_codes, rng.integers(0, max_codes + 1), replace=False)).astype(np.int32) for _ in range(n)]
+    return np.array([len(codes) for codes in sets], dtype=np.int32), np.concatenate([np.empty(0, dtype=np.int32)] + sets)
+
+
+def churning_population(ticks, n=60, seed=1):
+    """Yields (tick, columns) of a population in which agents leave and enter, age, seroconvert,
+    change age group, relationship status and empirical ego, and redraw their venues and apps."""
+    rng = np.random.default_rng(seed)
+    agents = pd.DataFrame({'agent_id': np.arange(n, dtype=np.int32),
+                           'age': rng.uniform(16, 29, n).astype(np.float32),
+                           'race_ethnicity': rng.integers(0, len(RACE_ETHNICITIES), n).astype(np.int8),
+                           'hiv_status': np.zeros(n, dtype=np.int8),
+                           'relationship_status': rng.integers(0, 2, n).astype(np.int8),
+                           'assigned_eego': rng.integers(0, len(EEGO_LABELS), n).astype(np.int32)})
+    next_id = n
+    for tick in ticks:
+        if tick != ticks[0]:
+            agents = agents[rng.random(len(agents)) > 0.1].copy()
+            agents['age'] = agents['age'] + np.float32(chistig.WEEKLY_AGING)
+            agents.loc[rng.random(len(agents)) < 0.1, 'hiv_status'] = 1
+            flip = rng.random(len(agents)) < 0.1
+            agents.loc[flip, 'relationship_status'] = 1 - agents.loc[flip, 'relationship_status']
+            redraw = rng.random(len(agents)) < 0.05
+            agents.loc[redraw, 'assigned_eego'] = rng.integers(0, len(EEGO_LABELS), int(redraw.sum())).astype(np.int32)
+            entering = int(rng.integers(0, 8))
+            agents = pd.concat([agents, pd.DataFrame({'agent_id': np.arange(next_id, next_id + entering, dtype=np.int32),
+                                                      'age': np.full(entering, 16.0, dtype=np.float32),
+                                                      'race_ethnicity': rng.integers(0, len(RACE_ETHNICITIES), entering).astype(np.int8),
+                                                      'hiv_status': np.zeros(entering, dtype=np.int8),
+                                                      'relationship_status': np.zeros(entering, dtype=np.int8),
+                                                      'assigned_eego': rng.integers(0, len(EEGO_LABELS), entering).astype(np.int32)})],
+                               ignore_index=True)
+            next_id += entering
+        columns = {name: agents[name].to_numpy() for name in agents.columns}
+        columns['agent_uid_rank'] = np.zeros(len(agents), dtype=np.int32)
+        columns['ego_id'] = np.array([f's{agent:05d}' for agent in columns['agent_id'].tolist()], dtype=object)
+        columns['age_group'] = (columns['age'] >= 21).astype(np.int8)
+        columns['venues_attended_count'], columns['venues_attended_codes'] = draw_code_sets(rng, len(agents), len(VENUE_LABELS), 4)
+        columns['apps_used_count'], columns['apps_used_codes'] = draw_code_sets(rng, len(agents), len(APP_LABELS), 2)
+        yield tick, columns
+
+
+def text_rows(tick, columns):
+    # the rows of a tick as Model.log_agents writes them to the text log
+    offsets = {name: np.concatenate([[0], np.cumsum(columns[name + '_count'])]) for name in chistig.AGENT_LOG_CODE_SETS}
+    rows = []
+    for row, egoid in enumerate(columns['ego_id']):
+        code_sets = [chistig.join_labels(LABELS[name], columns[name + '_codes'][offsets[name][row]:offsets[name][row + 1]], egoid)
+                     for name in chistig.AGENT_LOG_CODE_SETS]
+        rows.append([tick, int(columns['agent_id'][row]), int(columns['agent_uid_rank'][row]), egoid, columns['age'][row],
+                     AGE_GROUPS[columns['age_group'][row]], RACE_ETHNICITIES[columns['race_ethnicity'][row]],
+                     int(columns['hiv_status'][row]), int(columns['relationship_status'][row]),
+                     EEGO_LABELS[columns['assigned_eego'][row]]] + code_sets)
+    return rows
+
+
+def write_logs(directory, ticks):
+    comm = MPI.COMM_WORLD
+    text = logging.TabularLogger(comm, os.path.join(directory, 'agent_log.txt'), list(chistig.AGENT_LOG_COLUMNS))
+    columnar = chistig.ColumnarAgentLogger(comm, os.path.join(directory, 'agent_log.col'), LABELS, group_ticks=4)
+    delta = chistig.DeltaAgentLogger(comm, os.path.join(directory, 'agent_log.delta'), LABELS, group_ticks=4, keyframe_ticks=5)
+    for tick, columns in churning_population(ticks):
+        for row in text_rows(tick, columns):
+            text.log_row(*row)
+        text.write()
+        for logger in (columnar, delta):
+            logger.log_tick(tick, columns)
+            logger.write()
+    text.close()
+    columnar.close()
+    delta.close()
+    return pd.read_csv(os.path.join(directory, 'agent_log.txt'))
+
+
+def assert_same_log(frame, text):
+    frame = frame.sort_values(['tick', 'agent_id']).reset_index(drop=True)
+    text = text.sort_values(['tick', 'agent_id']).reset_index(drop=True)
+    assert(frame.shape == text.shape)
+    for name in chistig.AGENT_LOG_COLUMNS:
+        if name == 'age':
+            assert(np.abs(frame[name].to_numpy(dtype=np.float64) - text[name].to_numpy()).max() < 1e-5)
+        else:
+            assert((frame[name].astype(str).to_numpy() == text[name].astype(str).to_numpy()).all()), name
+
+
+def test_columnar_and_delta_logs_reproduce_the_text_log(tmp_path):
+    text = write_logs(str(tmp_path), list(range(3, 21)))
+    assert_same_log(chistig.AgentLogReader(str(tmp_path / 'agent_log.col')).frame(), text)
+    assert_same_log(chistig.DeltaAgentLogReader(str(tmp_path / 'agent_log.delta')).frame(), text)
+    # a tick range in between keyframes is reconstructed from the keyframe before it
+    assert_same_log(chistig.DeltaAgentLogReader(str(tmp_path / 'agent_log.delta')).frame(ticks=(11, 13)),
+                    text[(text.tick >= 11) & (text.tick <= 13)])
+
+
+def test_logs_without_footer_are_read_up_to_the_last_complete_group(tmp_path):
+    text = write_logs(str(tmp_path), list(range(3, 21)))
+    for fname, reader in (('agent_log.col', chistig.AgentLogReader), ('agent_log.delta', chistig.DeltaAgentLogReader)):
+        with open(tmp_path / fname, 'rb') as f:
+            data = f.read()
+        groups = reader(str(tmp_path / fname)).groups
+        # cut into the columns of the last group, as if the run was killed while writing it
+        cut = tmp_path / ('cut.' + fname)
+        with open(cut, 'wb') as f:
+            f.write(data[:min(offset for offset, _, _, _ in groups[-1]['columns'].values()) + 10])
+        truncated = reader(str(cut))
+        assert(not truncated.complete and len(truncated.groups) == len(groups) - 1)
+        assert_same_log(truncated.frame(), text[text.tick <= groups[-2]['tick_max']])
+
+
+def test_empty_selections_are_read_as_empty_frames(tmp_path):
+    empty = tmp_path / 'empty'
+    empty.mkdir()
+    write_logs(str(empty), [])
+    write_logs(str(tmp_path), list(range(3, 21)))
+    for fname, reader in (('agent_log.col', chistig.AgentLogReader), ('agent_log.delta', chistig.DeltaAgentLogReader)):
+        # a log without any group, and a tick range after the logged ticks
+        for frame in (reader(str(empty / fname)).frame(), reader(str(tmp_path / fname)).frame(ticks=(30, 40))):
+            assert(list(frame.columns) == list(chistig.AGENT_LOG_COLUMNS) and len(frame) == 0)
+            assert(frame['tick'].dtype == np.int32 and frame['age'].dtype == np.float32)
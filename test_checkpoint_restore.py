@@ -0,0 +1,62 @@
+"""Continuing a checkpointed run: the resumed segment, which opens its logs with the same params,
+must write its columnar or delta agent log and event file next to those of the first segment
+instead of overwriting them. Run with python -m pytest test_checkpoint_restore.py"""
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+
+import chistig_colocation_model_reticulate as chistig
+
+
+def write_params(directory, log_format, n=300):
+    """Writes a small synthetic population drawn from the demographic buckets of chistig_params.yaml,
+    and params that log every tick of it in the given format, returning the params file."""
+    params = yaml.safe_load(open('chistig_params.yaml'))
+    buckets = {int(code): eegos.split('|') for code, eegos in params['empop.demo.buckets'].items()}
+    rng = np.random.default_rng(1)
+    race_ethnicity = rng.integers(0, len(chistig.RACE_ETHNICITIES), n)
+    age = rng.uniform(16, 30, n)
+    democode = np.where(age < 21, chistig.DEMOCODES_16TO20[race_ethnicity], chistig.DEMOCODES_21TO29[race_ethnicity])
+    pd.DataFrame({'numeric_id': np.arange(1, n + 1), 'egoid': [f's{ego:05d}' for ego in range(1, n + 1)], 'age': age,
+                  'agegroup': np.where(age < 21, '16to20', '21to29'), 'race_ethnicity': np.array(chistig.RACE_ETHNICITIES)[race_ethnicity],
+                  'demographic_bucket': democode, 'hiv_status': (rng.random(n) < 0.1).astype(int),
+                  'any_serious': (rng.random(n) < 0.3).astype(int),
+                  'assigned_empego': [rng.choice(buckets[code]) for code in democode.tolist()]}).to_csv(directory / 'egos.csv', index=False)
+    params.update({'synthpop.ego.file': str(directory / 'egos.csv'), 'burnin.time.weeks': 0, 'agent.log.format': log_format,
+                   'agent.log.file': str(directory / f'agent_log.{log_format}'), 'agent.log.group.ticks': 2,
+                   'agent.log.keyframe.ticks': 2, 'events.file': str(directory / 'events.bin')})
+    with open(directory / 'params.yaml', 'w') as f:
+        yaml.safe_dump(params, f)
+    return str(directory / 'params.yaml')
+
+
+@pytest.mark.parametrize('log_format', ['columnar', 'delta'])
+def test_restored_run_keeps_the_logs_of_the_first_segment(tmp_path, log_format):
+    reader = chistig.AgentLogReader if log_format == 'columnar' else chistig.DeltaAgentLogReader
+    params_file = write_params(tmp_path, log_format)
+    # the first segment runs 5 ticks and is checkpointed at the end of its job
+    chistig.run(chistig.create_params(params_file))
+    for _ in range(5):
+        chistig.next_step()
+    # egos that turn 21 are recorded as aged events
+    chistig.update_age_groups(pd.DataFrame({'numeric.id': [1.0, 2.0]}))
+    chistig.checkpoint(str(tmp_path / 'checkpoint.npz'))
+    chistig.end_chistig()
+    first = reader(str(tmp_path / f'agent_log.{log_format}')).frame()
+    first_events = chistig.read_events(str(tmp_path / 'events.bin'))
+
+    # the next job sets the model up with the same params and continues it for 3 more ticks
+    chistig.run(chistig.create_params(params_file))
+    chistig.restore(str(tmp_path / 'checkpoint.npz'))
+    chistig.update_age_groups(pd.DataFrame({'numeric.id': [3.0]}))
+    for _ in range(3):
+        chistig.next_step()
+    chistig.end_chistig()
+
+    assert(sorted(first.tick.unique().tolist()) == [1, 2, 3, 4, 5])
+    assert(reader(str(tmp_path / f'agent_log.{log_format}')).frame().equals(first))
+    assert(len(first_events) == 2 and chistig.read_events(str(tmp_path / 'events.bin')).equals(first_events))
+    second = reader(str(tmp_path / f'agent_log_1.{log_format}')).frame()
+    assert(sorted(second.tick.unique().tolist()) == [6, 7, 8])
+    assert(len(chistig.read_events(str(tmp_path / 'events_1.bin'))) == 1)